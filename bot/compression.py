@@ -1,31 +1,389 @@
 """
 File compression utilities supporting multiple algorithms.
-Handles ZIP, GZIP, and LZMA compression with progress tracking.
+Handles ZIP, GZIP, LZMA and (when zstandard is installed) Zstandard compression
+with progress tracking.
 """
 
 import asyncio
+import collections
+import concurrent.futures
 import gzip
+import io
 import lzma
 import logging
+import math
+import mmap
 import os
+import shutil
+import struct
 import zipfile
-from typing import Optional, Tuple
+import zlib
+from typing import List, Optional, Tuple
+
+from .utils import quiet_unlink
 
 logger = logging.getLogger(__name__)
 
+# Copy buffer for streaming codecs (matches CPython's gzip READ_BUFFER_SIZE)
+_READ_BUFFER_SIZE = 128 * 1024
+
+# Output buffer for codec streams: coalesces many small compressed chunks
+# into few large write() calls
+_WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Inputs at least this large are mapped into memory and fed to codecs in
+# slices of _MMAP_CHUNK_SIZE, avoiding a copy into a bytes object per read
+_MMAP_THRESHOLD = 1024 * 1024
+_MMAP_CHUNK_SIZE = 1024 * 1024
+
+try:
+    # python-isal is optional; igzip writes standard .gz streams much faster
+    from isal import igzip
+
+    def _open_gzip(path: str, mode: str, level: int = 6):
+        # igzip only accepts levels 0-3, so map the 1-9 zlib scale onto it
+        return igzip.open(path, mode, compresslevel=min(level // 3, 3))
+except ImportError:
+    def _open_gzip(path: str, mode: str, level: int = 6):
+        return gzip.open(path, mode, compresslevel=level)
+
+def _open_lzma(path: str, mode: str, level: int = 6):
+    return lzma.open(path, mode, preset=level if 'w' in mode else None)
+
+try:
+    # zstandard is optional; when installed it adds the 'zstd' algorithm
+    import zstandard
+    
+    def _open_zstd(path: str, mode: str, level: int = 6):
+        # threads=-1 compresses on every core; closefd=False leaves passed-in file objects open, like gzip.open
+        cctx = zstandard.ZstdCompressor(level=level, threads=-1) if 'w' in mode else None
+        return zstandard.open(path, mode, cctx=cctx, closefd=False)
+except ImportError:
+    zstandard = None
+
+# Formats that are already compressed; running a codec over them gains ~nothing
+_COMPRESSED_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.webm',
+    '.mov', '.m4a', '.aac', '.ogg', '.zip', '.rar', '.7z', '.gz', '.xz', '.bz2',
+})
+
+# Text formats, which GZIP handles well
+_TEXT_EXTENSIONS = frozenset({
+    '.txt', '.log', '.csv', '.json', '.xml', '.html', '.css', '.js', '.py', '.md',
+})
+
+# Entropy (bits/byte) of a sample above which DEFLATE is expected to gain <2%
+# (store instead), and above which only the fastest level is worth running
+_STORE_ENTROPY = 7.5
+_FAST_ENTROPY = 7.0
+_ENTROPY_SAMPLE_SIZE = 64 * 1024
+
+# Compressed file extension -> algorithm used to decompress it
+_EXTENSION_TO_ALGORITHM = {
+    '.zip': 'zip',
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.xz': 'lzma',
+    '.lzma': 'lzma',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+}
+
+# Leading magic bytes of already-compressed formats
+_COMPRESSED_SIGNATURES = (
+    b'\xff\xd8\xff',            # JPEG
+    b'\x89PNG',                  # PNG
+    b'\x1f\x8b',                 # GZIP
+    b'7z\xbc\xaf',               # 7z
+    b'PK\x03\x04',               # ZIP
+    b'\x00\x00\x01\xba',         # MPEG-PS
+    b'\xfd7zXZ\x00',             # XZ
+    b'Rar!',                     # RAR
+    b'ID3',                      # MP3
+)
+
+def _has_compressed_signature(header: bytes) -> bool:
+    """Check leading file bytes against known compressed formats."""
+    # ISO base media (MP4/MOV/M4A) carries its 'ftyp' box at offset 4
+    return header.startswith(_COMPRESSED_SIGNATURES) or header[4:8] == b'ftyp'
+
+# Dedicated pool for codec work so compressions don't queue behind (or starve)
+# other users of the default executor. zlib/lzma release the GIL while
+# compressing, so threads scale across cores without process IPC.
+_CODEC_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 1,
+    thread_name_prefix='codec'
+)
+
+# Stream codecs: algorithm -> opener(path_or_fileobj, mode, level) returning a file object
+CODECS = {
+    'gzip': _open_gzip,
+    'lzma': _open_lzma,
+}
+if zstandard is not None:
+    CODECS['zstd'] = _open_zstd
+
+def _open_sequential(path: str):
+    """Open a file for a single front-to-back read, hinting the kernel to read ahead."""
+    f = open(path, 'rb')
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    return f
+
+def _feed_codec(input_path: str, f_out):
+    """Stream a file into a codec writer, via mmap for larger files."""
+    with _open_sequential(input_path) as f_in:
+        size = os.fstat(f_in.fileno()).st_size
+        if size < _MMAP_THRESHOLD:
+            shutil.copyfileobj(f_in, f_out, _READ_BUFFER_SIZE)
+            return
+        
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            # The view must be released before the mapping can close
+            with memoryview(mm) as view:
+                for offset in range(0, size, _MMAP_CHUNK_SIZE):
+                    f_out.write(view[offset:offset + _MMAP_CHUNK_SIZE])
+
+def _copy_range(in_fd: int, out_fd: int, count: int):
+    """Copy count bytes between file descriptors, in-kernel via sendfile where possible."""
+    offset = os.lseek(in_fd, 0, os.SEEK_CUR)
+    if hasattr(os, 'sendfile'):
+        try:
+            while count > 0:
+                sent = os.sendfile(out_fd, in_fd, offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        except OSError:
+            # sendfile to regular files is Linux-only; finish with plain reads
+            pass
+    
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    while count > 0:
+        chunk = os.read(in_fd, min(count, _READ_BUFFER_SIZE))
+        if not chunk:
+            break
+        os.write(out_fd, chunk)
+        count -= len(chunk)
+    
+    if count:
+        raise IOError("Input file shrank while copying")
+
+def _write_stored_zip(input_path: str, output_path: str):
+    """
+    Write a single-entry ZIP_STORED archive. Only the CRC pass reads through
+    Python; the payload itself is copied with sendfile.
+    """
+    zinfo = zipfile.ZipInfo.from_file(input_path, os.path.basename(input_path))
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.compress_size = zinfo.file_size
+    zinfo.header_offset = 0
+    
+    crc = 0
+    with _open_sequential(input_path) as f_in:
+        for chunk in iter(lambda: f_in.read(_READ_BUFFER_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    zinfo.CRC = crc
+    
+    try:
+        filename = zinfo.filename.encode('ascii')
+        flag_bits = zinfo.flag_bits
+    except UnicodeEncodeError:
+        filename = zinfo.filename.encode('utf-8')
+        flag_bits = zinfo.flag_bits | 0x800
+    
+    dt = zinfo.date_time
+    dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+    dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+    
+    header = zinfo.FileHeader(zip64=False)
+    centdir = struct.pack(
+        zipfile.structCentralDir, zipfile.stringCentralDir,
+        zinfo.create_version, zinfo.create_system, zinfo.extract_version, zinfo.reserved,
+        flag_bits, zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+        zinfo.compress_size, zinfo.file_size, len(filename), 0, 0, 0,
+        zinfo.internal_attr, zinfo.external_attr, zinfo.header_offset
+    ) + filename
+    endrec = struct.pack(
+        zipfile.structEndArchive, zipfile.stringEndArchive,
+        0, 0, 1, 1, len(centdir), len(header) + zinfo.file_size, 0
+    )
+    
+    # Unbuffered so our writes and sendfile share one file position
+    with open(input_path, 'rb', buffering=0) as f_in, open(output_path, 'wb', buffering=0) as f_out:
+        f_out.write(header)
+        _copy_range(f_in.fileno(), f_out.fileno(), zinfo.file_size)
+        f_out.write(centdir + endrec)
+
+# Incremental decompressors for formats that can be decoded front to back
+_STREAM_DECOMPRESSORS = {
+    'gzip': lambda: zlib.decompressobj(wbits=31),
+    'lzma': lzma.LZMADecompressor,
+}
+if zstandard is not None:
+    _STREAM_DECOMPRESSORS['zstd'] = lambda: zstandard.ZstdDecompressor().decompressobj()
+
+class DecompressStream:
+    """
+    Writable sink that decompresses chunks as they arrive, so a download can
+    be decoded without first landing on disk in compressed form. write() is
+    awaitable and runs the codec on the codec pool, as Telethon's
+    download_media accepts.
+    """
+    
+    def __init__(self, algorithm: str, output_path: str):
+        self._factory = _STREAM_DECOMPRESSORS[algorithm]
+        self._decompressor = self._factory()
+        self.output_path = output_path
+        self._out = open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+    
+    def _decompress(self, chunk: bytes):
+        decompressor = self._decompressor
+        self._out.write(decompressor.decompress(chunk))
+        # Concatenated gzip members / xz streams each need a fresh decoder
+        while decompressor.eof and decompressor.unused_data:
+            data = decompressor.unused_data
+            decompressor = self._decompressor = self._factory()
+            self._out.write(decompressor.decompress(data))
+    
+    async def write(self, chunk: bytes) -> int:
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, self._decompress, chunk)
+        return len(chunk)
+    
+    def close(self):
+        """Finish the output file, failing if the compressed stream was cut short."""
+        self._out.close()
+        if not self._decompressor.eof:
+            quiet_unlink(self.output_path)
+            raise EOFError("Compressed stream ended before the end-of-stream marker was reached")
+    
+    def abort(self):
+        """Discard the partial output."""
+        self._out.close()
+        quiet_unlink(self.output_path)
+
+class CompressStream:
+    """
+    Writable sink that compresses chunks as they arrive, so a download is
+    compressed while it is still in flight instead of landing on disk raw
+    and being read back. Like DecompressStream, write() is awaitable and
+    runs the codec on the codec pool.
+    
+    The first chunk decides the treatment, as compress_file does for whole
+    files: already-compressed data is stored as-is (algorithm becomes
+    'none') and high-entropy data gets a cheaper ZIP level.
+    """
+    
+    def __init__(self, algorithm: str, level: int, output_path: str, opener=None,
+                 arcname: str = 'file', size_hint: Optional[int] = None):
+        self.algorithm = algorithm
+        self.output_path = output_path
+        self._level = level
+        self._opener = opener
+        self._arcname = arcname
+        self._size_hint = size_hint
+        self._raw = open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+        self._zip = None
+        self._sink = None
+    
+    def _start(self, header: bytes):
+        if _has_compressed_signature(header):
+            self.algorithm = 'none'
+            self._sink = self._raw
+        elif self.algorithm == 'zip':
+            entropy = CompressionManager._shannon_entropy(header[:_ENTROPY_SAMPLE_SIZE])
+            level = self._level
+            if entropy > _STORE_ENTROPY:
+                level = 0
+            elif entropy > _FAST_ENTROPY:
+                level = min(level, 1)
+            self._zip = zipfile.ZipFile(
+                self._raw, 'w',
+                zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED,
+                compresslevel=level or None
+            )
+            # The final size is unknown up front; only skip ZIP64 when the hint rules it out
+            force_zip64 = self._size_hint is None or self._size_hint > zipfile.ZIP64_LIMIT
+            self._sink = self._zip.open(self._arcname, 'w', force_zip64=force_zip64)
+        else:
+            self._sink = self._opener(self._raw, 'wb', self._level)
+    
+    def _compress(self, chunk: bytes):
+        if self._sink is None:
+            self._start(bytes(chunk[:_ENTROPY_SAMPLE_SIZE]))
+        self._sink.write(chunk)
+    
+    async def write(self, chunk: bytes) -> int:
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, self._compress, chunk)
+        return len(chunk)
+    
+    def _finish(self):
+        if self._sink is None:
+            self._start(b'')
+        if self._sink is not self._raw:
+            self._sink.close()
+        if self._zip is not None:
+            self._zip.close()
+        self._raw.close()
+    
+    async def close(self):
+        """Flush the codec and finish the output file."""
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, self._finish)
+    
+    def abort(self):
+        """Discard the partial output."""
+        self._raw.close()
+        quiet_unlink(self.output_path)
+
+def supported_algorithms() -> List[str]:
+    """Algorithms usable in this installation ('zstd' only when zstandard is installed)."""
+    return ['zip', 'gzip', 'lzma'] + (['zstd'] if 'zstd' in CODECS else [])
+
 class CompressionManager:
     def __init__(self, config):
         self.config = config
-        self.supported_algorithms = ['zip', 'gzip', 'lzma']
+        self.supported_algorithms = supported_algorithms()
+        self._codecs = dict(CODECS)
+        # Algorithm -> coroutine method, resolved once instead of per call
+        self._compress_dispatch = {
+            'zip': self._compress_zip,
+            'gzip': self._compress_gzip,
+            'lzma': self._compress_lzma,
+        }
+        self._decompress_dispatch = {
+            'zip': self._decompress_zip,
+            'gzip': self._decompress_gzip,
+            'lzma': self._decompress_lzma,
+        }
+        if 'zstd' in self._codecs:
+            self._compress_dispatch['zstd'] = self._compress_zstd
+            self._decompress_dispatch['zstd'] = self._decompress_zstd
+        # Multi-threaded external compressors, used for large files when present
+        self._external_tools = {
+            'gzip': shutil.which('pigz'),
+            'lzma': shutil.which('xz'),
+        }
     
-    async def compress_file(self, input_path: str, algorithm: str = 'zip', level: int = 6) -> str:
+    def register_codec(self, algorithm: str, opener):
+        """Override the stream opener used for a streaming algorithm (gzip/lzma/zstd)."""
+        self._codecs[algorithm] = opener
+    
+    async def compress_file(self, input_path: str, algorithm: str = 'zip', level: int = 6,
+                            output_path: Optional[str] = None) -> str:
         """
         Compress a file using the specified algorithm.
         
         Args:
             input_path: Path to input file
-            algorithm: Compression algorithm ('zip', 'gzip', 'lzma')
+            algorithm: Compression algorithm ('zip', 'gzip', 'lzma', or 'zstd' when installed)
             level: Compression level (1-9)
+            output_path: Optional output path (defaults to input_path + '.<algorithm>')
             
         Returns:
             Path to compressed file
@@ -36,22 +394,18 @@ class CompressionManager:
         if not os.path.exists(input_path):
             raise FileNotFoundError(f"Input file not found: {input_path}")
         
-        # Generate output filename
-        base_name = os.path.basename(input_path)
-        output_path = os.path.join(
-            os.path.dirname(input_path),
-            f"{base_name}.{algorithm}"
-        )
+        # Generate output filename if not provided
+        if output_path is None:
+            base_name = os.path.basename(input_path)
+            output_path = os.path.join(
+                os.path.dirname(input_path),
+                f"{base_name}.{algorithm}"
+            )
         
         logger.info(f"Compressing {input_path} using {algorithm} (level {level})")
         
         try:
-            if algorithm == 'zip':
-                await self._compress_zip(input_path, output_path, level)
-            elif algorithm == 'gzip':
-                await self._compress_gzip(input_path, output_path, level)
-            elif algorithm == 'lzma':
-                await self._compress_lzma(input_path, output_path, level)
+            await self._compress_dispatch[algorithm](input_path, output_path, level)
             
             logger.info(f"Compression complete: {output_path}")
             return output_path
@@ -59,13 +413,38 @@ class CompressionManager:
         except Exception as e:
             logger.error(f"Compression failed: {e}")
             # Cleanup partial file
-            if os.path.exists(output_path):
-                try:
-                    os.remove(output_path)
-                except:
-                    pass
+            quiet_unlink(output_path)
             raise
     
+    async def compress_bytes(self, data: bytes, algorithm: str = 'zip', level: int = 6,
+                             arcname: str = 'file') -> bytes:
+        """
+        Compress an in-memory buffer, for small files that never touch disk.
+        
+        Args:
+            data: Raw file contents
+            algorithm: Compression algorithm ('zip', 'gzip', 'lzma', or 'zstd' when installed)
+            level: Compression level (1-9)
+            arcname: Entry name inside ZIP archives
+            
+        Returns:
+            Compressed bytes in the same format compress_file produces
+        """
+        if algorithm not in self.supported_algorithms:
+            raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+        
+        def _compress():
+            buffer = io.BytesIO()
+            if algorithm == 'zip':
+                with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
+                    zf.writestr(arcname, data)
+            else:
+                with self._codecs[algorithm](buffer, 'wb', level) as f_out:
+                    f_out.write(data)
+            return buffer.getvalue()
+        
+        return await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _compress)
+    
     async def decompress_file(self, input_path: str, output_path: Optional[str] = None) -> str:
         """
         Decompress a file based on its extension.
@@ -81,13 +460,8 @@ class CompressionManager:
             raise FileNotFoundError(f"Compressed file not found: {input_path}")
         
         # Determine compression type from extension
-        if input_path.endswith('.zip'):
-            algorithm = 'zip'
-        elif input_path.endswith('.gz') or input_path.endswith('.gzip'):
-            algorithm = 'gzip'
-        elif input_path.endswith('.xz') or input_path.endswith('.lzma'):
-            algorithm = 'lzma'
-        else:
+        algorithm = _EXTENSION_TO_ALGORITHM.get(os.path.splitext(input_path)[1].lower())
+        if algorithm is None:
             raise ValueError(f"Unable to determine compression type from filename: {input_path}")
         
         # Generate output path if not provided
@@ -104,52 +478,135 @@ class CompressionManager:
         logger.info(f"Decompressing {input_path} using {algorithm}")
         
         try:
-            if algorithm == 'zip':
-                return await self._decompress_zip(input_path, output_path)
-            elif algorithm == 'gzip':
-                await self._decompress_gzip(input_path, output_path)
-                return output_path
-            elif algorithm == 'lzma':
-                await self._decompress_lzma(input_path, output_path)
-                return output_path
+            return await self._decompress_dispatch[algorithm](input_path, output_path)
                 
         except Exception as e:
             logger.error(f"Decompression failed: {e}")
             raise
     
+    def open_decompress_stream(self, algorithm: str, output_path: str) -> Optional[DecompressStream]:
+        """
+        Open a streaming decompressor writing to output_path, or return None
+        if the algorithm needs random access to its input (ZIP).
+        """
+        if algorithm not in _STREAM_DECOMPRESSORS:
+            return None
+        return DecompressStream(algorithm, output_path)
+    
+    def open_compress_stream(self, algorithm: str, level: int, output_path: str,
+                             arcname: str = 'file', size_hint: Optional[int] = None) -> Optional[CompressStream]:
+        """
+        Open a streaming compressor writing to output_path, or return None
+        when a multi-threaded external compressor would handle a file of
+        size_hint bytes faster from disk.
+        """
+        if algorithm not in self.supported_algorithms:
+            raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+        if self._external_tools.get(algorithm) and (size_hint or 0) > self.config.PARALLEL_THRESHOLD:
+            return None
+        return CompressStream(algorithm, level, output_path, self._codecs.get(algorithm), arcname, size_hint)
+
     async def _compress_zip(self, input_path: str, output_path: str, level: int):
         """Compress file using ZIP algorithm."""
+        with open(input_path, 'rb') as f:
+            entropy = self._shannon_entropy(f.read(_ENTROPY_SAMPLE_SIZE))
+        
+        if entropy > _STORE_ENTROPY:
+            level = 0
+        elif entropy > _FAST_ENTROPY:
+            level = min(level, 1)
+        
+        if level == 0 and os.path.getsize(input_path) <= zipfile.ZIP64_LIMIT:
+            await self._compress_zip_stored(input_path, output_path)
+            return
+        
         def _zip_compress():
             with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
                 zf.write(input_path, os.path.basename(input_path))
         
-        await asyncio.get_event_loop().run_in_executor(None, _zip_compress)
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _zip_compress)
+    
+    @staticmethod
+    def _shannon_entropy(sample: bytes) -> float:
+        """Byte-level Shannon entropy of a sample, in bits per byte (0-8)."""
+        if not sample:
+            return 0.0
+        
+        total = len(sample)
+        return -sum(
+            count / total * math.log2(count / total)
+            for count in collections.Counter(sample).values()
+        )
+    
+    async def _compress_zip_stored(self, input_path: str, output_path: str):
+        """Store file in a ZIP archive without compression."""
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _write_stored_zip, input_path, output_path)
     
     async def _compress_gzip(self, input_path: str, output_path: str, level: int):
         """Compress file using GZIP algorithm."""
+        pigz = self._external_tool('gzip', input_path)
+        if pigz and await self._compress_external(
+            [pigz, f'-{level}', '-c', '-p', str(os.cpu_count() or 1), input_path], output_path
+        ):
+            return
+        
         def _gzip_compress():
-            with open(input_path, 'rb') as f_in:
-                with gzip.open(output_path, 'wb', compresslevel=level) as f_out:
-                    while True:
-                        chunk = f_in.read(65536)  # 64KB chunks
-                        if not chunk:
-                            break
-                        f_out.write(chunk)
+            with open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as raw_out, \
+                    self._codecs['gzip'](raw_out, 'wb', level) as f_out:
+                _feed_codec(input_path, f_out)
         
-        await asyncio.get_event_loop().run_in_executor(None, _gzip_compress)
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _gzip_compress)
     
     async def _compress_lzma(self, input_path: str, output_path: str, level: int):
         """Compress file using LZMA algorithm."""
+        xz = self._external_tool('lzma', input_path)
+        if xz and await self._compress_external(
+            [xz, f'-{level}', '-T0', '-c', input_path], output_path
+        ):
+            return
+        
         def _lzma_compress():
-            with open(input_path, 'rb') as f_in:
-                with lzma.open(output_path, 'wb', preset=level) as f_out:
-                    while True:
-                        chunk = f_in.read(65536)  # 64KB chunks
-                        if not chunk:
-                            break
-                        f_out.write(chunk)
+            with open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as raw_out, \
+                    self._codecs['lzma'](raw_out, 'wb', level) as f_out:
+                _feed_codec(input_path, f_out)
+        
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _lzma_compress)
+    
+    async def _compress_zstd(self, input_path: str, output_path: str, level: int):
+        """Compress file using Zstandard (multi-threaded inside libzstd)."""
+        def _zstd_compress():
+            with open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as raw_out, \
+                    self._codecs['zstd'](raw_out, 'wb', level) as f_out:
+                _feed_codec(input_path, f_out)
+        
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _zstd_compress)
+    
+    def _external_tool(self, algorithm: str, input_path: str) -> Optional[str]:
+        """Return the external compressor to use for this file, if any."""
+        tool = self._external_tools.get(algorithm)
+        if tool and os.path.getsize(input_path) > self.config.PARALLEL_THRESHOLD:
+            return tool
+        return None
+    
+    async def _compress_external(self, args: list, output_path: str) -> bool:
+        """Run an external compressor writing to output_path. Returns False on failure."""
+        try:
+            with open(output_path, 'wb') as f_out:
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdout=f_out,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+        except OSError as e:
+            logger.warning(f"External compressor {args[0]} failed to start: {e}")
+            return False
+        
+        if process.returncode != 0:
+            logger.warning(f"External compressor {args[0]} exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+            return False
         
-        await asyncio.get_event_loop().run_in_executor(None, _lzma_compress)
+        return True
     
     async def _decompress_zip(self, input_path: str, output_dir: str) -> str:
         """Decompress ZIP file and return path to extracted file."""
@@ -164,33 +621,34 @@ class CompressionManager:
                 else:
                     raise ValueError("ZIP file is empty")
         
-        return await asyncio.get_event_loop().run_in_executor(None, _zip_decompress)
+        return await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _zip_decompress)
     
-    async def _decompress_gzip(self, input_path: str, output_path: str):
-        """Decompress GZIP file."""
+    async def _decompress_gzip(self, input_path: str, output_path: str) -> str:
+        """Decompress GZIP file and return output_path."""
         def _gzip_decompress():
-            with gzip.open(input_path, 'rb') as f_in:
-                with open(output_path, 'wb') as f_out:
-                    while True:
-                        chunk = f_in.read(65536)  # 64KB chunks
-                        if not chunk:
-                            break
-                        f_out.write(chunk)
-        
-        await asyncio.get_event_loop().run_in_executor(None, _gzip_decompress)
-    
-    async def _decompress_lzma(self, input_path: str, output_path: str):
-        """Decompress LZMA file."""
+            with self._codecs['gzip'](input_path, 'rb') as f_in, open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as f_out:
+                shutil.copyfileobj(f_in, f_out, _READ_BUFFER_SIZE)
+        
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _gzip_decompress)
+        return output_path
+    
+    async def _decompress_lzma(self, input_path: str, output_path: str) -> str:
+        """Decompress LZMA file and return output_path."""
         def _lzma_decompress():
-            with lzma.open(input_path, 'rb') as f_in:
-                with open(output_path, 'wb') as f_out:
-                    while True:
-                        chunk = f_in.read(65536)  # 64KB chunks
-                        if not chunk:
-                            break
-                        f_out.write(chunk)
+            with self._codecs['lzma'](input_path, 'rb') as f_in, open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as f_out:
+                shutil.copyfileobj(f_in, f_out, _READ_BUFFER_SIZE)
+        
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _lzma_decompress)
+        return output_path
+    
+    async def _decompress_zstd(self, input_path: str, output_path: str) -> str:
+        """Decompress Zstandard file and return output_path."""
+        def _zstd_decompress():
+            with self._codecs['zstd'](input_path, 'rb') as f_in, open(output_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as f_out:
+                shutil.copyfileobj(f_in, f_out, _READ_BUFFER_SIZE)
         
-        await asyncio.get_event_loop().run_in_executor(None, _lzma_decompress)
+        await asyncio.get_running_loop().run_in_executor(_CODEC_EXECUTOR, _zstd_decompress)
+        return output_path
     
     def get_compression_info(self, original_size: int, compressed_size: int) -> dict:
         """Calculate compression statistics."""
@@ -206,18 +664,50 @@ class CompressionManager:
             'space_saved': original_size - compressed_size
         }
     
+    @staticmethod
+    def has_compressed_extension(filename: str) -> bool:
+        """Check whether a filename names an already-compressed format."""
+        return os.path.splitext(filename)[1].lower() in _COMPRESSED_EXTENSIONS
+    
+    def should_compress(self, file_path: str, filename: Optional[str] = None) -> bool:
+        """
+        Check whether a file is worth compressing.
+        
+        Args:
+            file_path: Path to file on disk
+            filename: Optional original filename (used for the extension check)
+            
+        Returns:
+            False for already-compressed formats (by extension or magic bytes)
+        """
+        if self.has_compressed_extension(filename or file_path):
+            return False
+        
+        try:
+            with open(file_path, 'rb') as f:
+                header = f.read(16)
+        except OSError:
+            return True
+        
+        return not _has_compressed_signature(header)
+    
+    def should_compress_bytes(self, data: bytes, filename: str) -> bool:
+        """In-memory variant of should_compress."""
+        if self.has_compressed_extension(filename):
+            return False
+        
+        return not _has_compressed_signature(bytes(data[:16]))
+    
     def recommend_algorithm(self, file_path: str, file_size: int) -> str:
         """Recommend compression algorithm based on file type and size."""
         file_ext = os.path.splitext(file_path)[1].lower()
         
         # Text files: GZIP is usually best
-        text_extensions = ['.txt', '.log', '.csv', '.json', '.xml', '.html', '.css', '.js', '.py', '.md']
-        if file_ext in text_extensions:
+        if file_ext in _TEXT_EXTENSIONS:
             return 'gzip'
         
         # Already compressed files: ZIP for compatibility
-        compressed_extensions = ['.jpg', '.png', '.mp3', '.mp4', '.zip', '.rar', '.7z']
-        if file_ext in compressed_extensions:
+        if file_ext in _COMPRESSED_EXTENSIONS:
             return 'zip'  # Minimal additional compression but good compatibility
         
         # Large files: LZMA for best compression
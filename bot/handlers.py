@@ -6,34 +6,33 @@ Manages user interactions, file processing, and bot responses.
 import asyncio
 import logging
 import os
+import string
 import time
-from typing import Optional
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
+from telegram.error import TimedOut
 from telethon import TelegramClient
 from telethon.tl.types import DocumentAttributeFilename
 
-from .compression import CompressionManager
+from .compression import CompressionManager, supported_algorithms
 from .storage import MegaStorageManager
-from .utils import format_file_size, calculate_compression_ratio, generate_file_id
+from .utils import format_file_size, calculate_compression_ratio, generate_file_id, quiet_unlink
 
 logger = logging.getLogger(__name__)
 
-class BotHandlers:
-    def __init__(self, bot_app, telethon_client: TelegramClient, config):
-        self.bot_app = bot_app
-        self.telethon_client = telethon_client
-        self.config = config
-        self.compression_manager = CompressionManager(config)
-        self.storage_manager = MegaStorageManager(config)
-        self.storage_manager.set_telethon_client(telethon_client)  # Enable channel storage
-        self.active_uploads = {}
-        self.user_settings = {}  # Store per-user compression preferences
-        
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command."""
-        welcome_text = """🤖 Welcome to Telegram File Bot!
+@dataclass(slots=True)
+class UserPrefs:
+    """Per-user preferences."""
+    compression: Optional[str] = None
+
+_DEFAULT_PREFS = UserPrefs()
+
+WELCOME_TEXT = """🤖 Welcome to Telegram File Bot!
 
 I can help you:
 • Upload files up to 4GB with compression
@@ -43,32 +42,18 @@ I can help you:
 
 Commands:
 /upload - Upload a file (or just send me any file)
-/download file_id - Download a file by ID
+/download file_id [file_id ...] - Download files by ID
 /list - Show your uploaded files
 /compress algorithm - Set compression preference
 /settings - View current settings
 /help - Show detailed help
 
-Supported compression: ZIP, GZIP, LZMA
+Supported compression: {algorithms}
 File size limit: 4GB per file
 
 Just send me any file to get started! 📁"""
-        
-        keyboard = [
-            [InlineKeyboardButton("📋 List Files", callback_data="list_files")],
-            [InlineKeyboardButton("⚙️ Settings", callback_data="settings")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            welcome_text,
-            reply_markup=reply_markup
-        )
-    
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /help command."""
-        help_text = """📖 Detailed Help
+
+HELP_TEXT = """📖 Detailed Help
 
 File Upload:
 • Send any file directly to the bot
@@ -79,10 +64,10 @@ File Upload:
 Commands:
 
 /upload - Start file upload mode
-/download file_id - Download file by ID
+/download file_id [file_id ...] - Download one or more files by ID
 /list - Show all your uploaded files
 /delete file_id - Delete a file
-/compress algorithm - Set compression (zip/gzip/lzma)
+/compress algorithm - Set compression ({algorithm_names})
 /settings - View current settings
 
 File Size Limits:
@@ -93,7 +78,7 @@ File Size Limits:
 Compression Options:
 • ZIP: Best compatibility, moderate compression
 • GZIP: Fast compression, good for text files
-• LZMA: Maximum compression, slower processing
+• LZMA: Maximum compression, slower processing{zstd_option}
 
 File Management:
 • Each uploaded file gets a unique ID
@@ -108,8 +93,132 @@ Tips:
 • Check /settings to view your current preferences
 
 Need more help? Contact the bot administrator."""
+
+# Algorithms offered depend on the installed codecs (zstd is optional)
+_AVAILABLE_ALGORITHMS = supported_algorithms()
+WELCOME_TEXT = WELCOME_TEXT.format(algorithms=", ".join(a.upper() for a in _AVAILABLE_ALGORITHMS))
+HELP_TEXT = HELP_TEXT.format(
+    algorithm_names="/".join(_AVAILABLE_ALGORITHMS),
+    zstd_option="\n• ZSTD: Fast multi-threaded compression, strong ratio" if 'zstd' in _AVAILABLE_ALGORITHMS else ""
+)
+
+# Config-derived fields are filled once per BotHandlers; only ${compression} varies per user
+SETTINGS_TEMPLATE = """
+⚙️ **Your Settings**
+
+**Compression Algorithm:** ${compression}
+**Compression Level:** ${level}/9
+**Max File Size:** ${max_size}
+**Temp Directory:** ${temp_dir}
+
+**Storage:**
+• Mega.nz Account: Connected ✅
+• Telegram Channel: ${channel}
+
+**Usage Tips:**
+• ZIP: Best for mixed file types
+• GZIP: Fastest compression
+• LZMA: Best compression ratio
+
+Use `/compress <algorithm>` to change compression.
+        """
+
+# Name prefix and extension for uploads that arrive without a filename
+_FALLBACK_NAMES = {
+    "photo": ("photo", ".jpg"),
+    "video": ("video", ".mp4"),
+    "audio": ("audio", ".mp3"),
+}
+
+# Shown by /compress for each available algorithm
+_ALGORITHM_DESCRIPTIONS = {
+    'zip': "Best compatibility, moderate compression",
+    'gzip': "Fast compression, good for text",
+    'lzma': "Maximum compression, slower",
+    'zstd': "Fast multi-threaded compression, strong ratio",
+}
+
+# Most file IDs accepted by one /download
+MAX_DOWNLOAD_BATCH = 10
+
+# Attempts for user-facing Bot API calls that time out, and the first retry
+# delay (doubled after each attempt)
+SEND_ATTEMPTS = 4
+SEND_RETRY_DELAY = 0.5
+
+# Minimum gap between intermediate progress edits of the same message (seconds)
+PROGRESS_EDIT_INTERVAL = 1.5
+
+# Uploads smaller than this are downloaded and compressed in memory
+IN_MEMORY_UPLOAD_LIMIT = 20 * 1024 * 1024
+
+# Timeouts after which the request is known not to have reached Telegram
+_UNSENT_TIMEOUTS = (httpx.PoolTimeout, httpx.ConnectTimeout)
+
+async def _with_retry(call, idempotent: bool = True):
+    """
+    Await call() (a Bot API request), retrying with exponential backoff when
+    it times out, so a busy connection pool doesn't lose a final reply.
+    Calls that aren't idempotent (sending a document) are retried only if the
+    request never went out; after a read timeout Telegram has usually
+    delivered it, and a retry would send a duplicate.
+    """
+    for attempt in range(SEND_ATTEMPTS):
+        try:
+            return await call()
+        except TimedOut as e:
+            if attempt == SEND_ATTEMPTS - 1:
+                raise
+            # PTB raises TimedOut from the underlying httpx timeout
+            if not idempotent and not isinstance(e.__cause__, _UNSENT_TIMEOUTS):
+                raise
+            await asyncio.sleep(SEND_RETRY_DELAY * 2 ** attempt)
+
+class BotHandlers:
+    def __init__(self, bot_app, telethon_client: TelegramClient, config):
+        self.bot_app = bot_app
+        self.telethon_client = telethon_client
+        self.config = config
+        self.compression_manager = CompressionManager(config)
+        self.storage_manager = MegaStorageManager(config)
+        self.storage_manager.set_telethon_client(telethon_client)  # Enable channel storage
+        self.active_uploads = {}
+        self.user_settings: Dict[int, UserPrefs] = {}  # Store per-user compression preferences
+        self._last_edit = {}  # (chat_id, message_id) -> monotonic time of last progress edit
+        self._pending_edits = {}  # (chat_id, message_id) -> in-flight progress edit task
+        # Uploads processed at once; further uploads wait for a free slot
+        self._upload_slots = asyncio.Semaphore(config.MAX_CONCURRENT_UPLOADS)
+        self._upload_tasks = set()
+        
+        # Static replies are built once and reused for every command
+        self._settings_template = string.Template(string.Template(SETTINGS_TEMPLATE).safe_substitute(
+            level=config.COMPRESSION_LEVEL,
+            max_size=format_file_size(config.MAX_FILE_SIZE),
+            temp_dir=config.TEMP_DIR.replace('$', '$$'),
+            channel='Connected' if config.STORAGE_CHANNEL_ID else 'Not configured'
+        ))
+        self._start_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 List Files", callback_data="list_files")],
+            [InlineKeyboardButton("⚙️ Settings", callback_data="settings")],
+            [InlineKeyboardButton("❓ Help", callback_data="help")]
+        ])
+        self._settings_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 My Files", callback_data="list_files")],
+            [InlineKeyboardButton("🗜️ ZIP", callback_data="compress_zip")],
+            [InlineKeyboardButton("⚡ GZIP", callback_data="compress_gzip")],
+            [InlineKeyboardButton("🎯 LZMA", callback_data="compress_lzma")]
+        ])
         
-        await update.message.reply_text(help_text)
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command."""
+        await update.message.reply_text(
+            WELCOME_TEXT,
+            reply_markup=self._start_markup
+        )
+    
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /help command."""
+        await update.message.reply_text(HELP_TEXT)
     
     async def upload_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /upload command."""
@@ -120,32 +229,39 @@ Need more help? Contact the bot administrator."""
             f"Send me any file and I'll compress it and store it locally.\n\n"
             f"Supported formats: Documents, Images, Videos, Audio\n"
             f"Max size: {format_file_size(self.config.MAX_FILE_SIZE)}\n"
-            f"Current compression: {self.user_settings.get(user_id, {}).get('compression', self.config.DEFAULT_COMPRESSION).upper()}"
+            f"Current compression: {(self.user_settings.get(user_id, _DEFAULT_PREFS).compression or self.config.DEFAULT_COMPRESSION).upper()}"
         )
     
     async def download_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /download command."""
+        """Handle /download command (one file ID, or several at once)."""
         if not context.args:
             await update.message.reply_text(
                 "❌ Please provide a file ID.\n\n"
-                "Usage: `/download <file_id>`\n"
+                "Usage: `/download <file_id> [<file_id> ...]`\n"
                 "Use /list to see your uploaded files.",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
+        if len(context.args) > 1:
+            await self._download_several(update, context.args)
+            return
+        
         file_id = context.args[0]
         user_id = update.effective_user.id
         
         # Show download progress message
         progress_msg = await update.message.reply_text("🔄 Starting download...")
+        decompressed_path = None
         
         try:
             # Download from Mega.nz and decompress
             result = await self.storage_manager.download_and_decompress(
-                file_id, user_id, progress_callback=lambda p: self._update_progress(progress_msg, f"📥 Downloading: {p}%")
+                file_id, user_id, progress_callback=lambda p: self._throttled_edit(progress_msg, f"📥 Downloading: {p}%")
             )
             
+            await self._settle_edits(progress_msg)
+            
             if not result:
                 await progress_msg.edit_text("❌ File not found or download failed.")
                 return
@@ -154,42 +270,92 @@ Need more help? Contact the bot administrator."""
             
             # Send file back to user
             await progress_msg.edit_text("📤 Sending file to you...")
-            
-            # Use appropriate method based on file size
-            if file_size < 50 * 1024 * 1024:  # 50MB - use Bot API
-                with open(decompressed_path, 'rb') as file:
-                    await update.message.reply_document(
-                        document=file,
-                        filename=original_filename,
-                        caption=f"📁 **{original_filename}**\nSize: {format_file_size(file_size)}"
-                    )
-            else:
-                # Use Telethon for large files
-                await self.telethon_client.send_file(
-                    update.effective_chat.id,
-                    decompressed_path,
-                    caption=f"📁 **{original_filename}**\nSize: {format_file_size(file_size)}",
-                    attributes=[DocumentAttributeFilename(file_name=original_filename)]
-                )
+            await self._send_file(update, decompressed_path, original_filename, file_size)
             
             await progress_msg.delete()
-            
-            # Cleanup temp file
-            try:
-                os.remove(decompressed_path)
-            except:
-                pass
                 
         except Exception as e:
             logger.error(f"Download error: {e}")
-            await progress_msg.edit_text(f"❌ Download failed: {str(e)}")
+            await self._settle_edits(progress_msg)
+            await _with_retry(lambda: progress_msg.edit_text(f"❌ Download failed: {str(e)}"))
+        
+        finally:
+            # The decompressed copy is temporary, whether or not it was sent
+            quiet_unlink(decompressed_path)
+    
+    async def _download_several(self, update: Update, file_ids: List[str]):
+        """Fetch several files concurrently (one batched channel lookup) and send each."""
+        user_id = update.effective_user.id
+        if len(file_ids) > MAX_DOWNLOAD_BATCH:
+            await update.message.reply_text(f"❌ At most {MAX_DOWNLOAD_BATCH} files per /download.")
+            return
+        
+        progress_msg = await update.message.reply_text(f"🔄 Downloading {len(file_ids)} files...")
+        results = []
+        failed = []
+        
+        try:
+            results = await self.storage_manager.download_many(file_ids, user_id)
+            await progress_msg.edit_text("📤 Sending files to you...")
+            
+            for file_id, result in zip(file_ids, results):
+                if not result:
+                    failed.append(file_id)
+                    continue
+                try:
+                    await self._send_file(update, *result)
+                except Exception as e:
+                    logger.error(f"Sending {file_id} failed: {e}")
+                    failed.append(file_id)
+            
+            if failed:
+                await _with_retry(lambda: progress_msg.edit_text(
+                    f"⚠️ Not found or failed: {', '.join(failed)}"
+                ))
+            else:
+                await progress_msg.delete()
+        
+        except Exception as e:
+            logger.error(f"Download error: {e}")
+            await _with_retry(lambda: progress_msg.edit_text(f"❌ Download failed: {str(e)}"))
+        
+        finally:
+            # The decompressed copies are temporary, whether or not they were sent
+            for result in results:
+                if result:
+                    quiet_unlink(result[0])
+    
+    async def _send_file(self, update: Update, file_path: str, original_filename: str, file_size: int):
+        """Send a decompressed file to the user, by Bot API or (for large files) Telethon."""
+        caption = f"📁 **{original_filename}**\nSize: {format_file_size(file_size)}"
+        
+        # Use appropriate method based on file size
+        if file_size < 50 * 1024 * 1024:  # 50MB - use Bot API
+            with open(file_path, 'rb') as file:
+                async def send_document():
+                    file.seek(0)  # A timed-out attempt may have consumed it
+                    return await update.message.reply_document(
+                        document=file,
+                        filename=original_filename,
+                        caption=caption
+                    )
+                
+                await _with_retry(send_document, idempotent=False)
+        else:
+            # Use Telethon for large files, uploading parts in parallel
+            await self.telethon_client.send_file(
+                update.effective_chat.id,
+                await self.storage_manager.upload_parts(file_path),
+                caption=caption,
+                attributes=[DocumentAttributeFilename(file_name=original_filename)]
+            )
     
     async def list_files_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /list command."""
         user_id = update.effective_user.id
         
         try:
-            files = await self.storage_manager.list_user_files(user_id)
+            files = await self.storage_manager.list_user_files(user_id, limit=10)
             
             if not files:
                 await update.message.reply_text(
@@ -200,10 +366,10 @@ Need more help? Contact the bot administrator."""
                 )
                 return
             
-            files_text = "📋 Your Files:\n\n"
-            for file_info in files[:10]:  # Show max 10 files
+            parts = ["📋 Your Files:\n\n"]
+            for file_info in files:  # Show max 10 files
                 # Determine storage icon based on type
-                storage_type = file_info.get('storage_type', 'local')
+                storage_type = file_info['storage_type']
                 if storage_type == 'telegram_channel':
                     storage_icon = "⚡"
                 elif storage_type == 'mega_cloud':
@@ -211,7 +377,7 @@ Need more help? Contact the bot administrator."""
                 else:
                     storage_icon = "💾"
                 
-                files_text += (
+                parts.append(
                     f"📁 {file_info['file_id']}\n"
                     f"{file_info['original_name']}\n"
                     f"Size: {format_file_size(file_info['original_size'])} → "
@@ -221,10 +387,12 @@ Need more help? Contact the bot administrator."""
                     f"Uploaded: {file_info['upload_date'][:10]}\n\n"
                 )
             
-            if len(files) > 10:
-                files_text += f"... and {len(files) - 10} more files\n"
+            total_files = self.storage_manager.count_user_files(user_id)
+            if total_files > len(files):
+                parts.append(f"... and {total_files - len(files)} more files\n")
             
-            files_text += "\nUse `/download <file_id>` to download a file."
+            parts.append("\nUse `/download <file_id>` to download a file.")
+            files_text = "".join(parts)
             
             await update.message.reply_text(files_text, parse_mode=ParseMode.MARKDOWN)
             
@@ -260,33 +428,32 @@ Need more help? Contact the bot administrator."""
     
     async def compress_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /compress command."""
+        supported = self.compression_manager.supported_algorithms
         if not context.args:
             await update.message.reply_text(
                 "⚙️ **Compression Settings**\n\n"
                 "Available algorithms:\n"
-                "• `zip` - Best compatibility, moderate compression\n"
-                "• `gzip` - Fast compression, good for text\n"
-                "• `lzma` - Maximum compression, slower\n\n"
-                "Usage: `/compress <algorithm>`\n"
+                + "".join(f"• `{name}` - {_ALGORITHM_DESCRIPTIONS[name]}\n" for name in supported)
+                + "\nUsage: `/compress <algorithm>`\n"
                 "Example: `/compress lzma`",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
         algorithm = context.args[0].lower()
-        if algorithm not in ["zip", "gzip", "lzma"]:
+        if algorithm not in supported:
             await update.message.reply_text(
                 "❌ Invalid compression algorithm.\n"
-                "Supported: zip, gzip, lzma",
+                f"Supported: {', '.join(supported)}",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
         user_id = update.effective_user.id
         if user_id not in self.user_settings:
-            self.user_settings[user_id] = {}
+            self.user_settings[user_id] = UserPrefs()
         
-        self.user_settings[user_id]['compression'] = algorithm
+        self.user_settings[user_id].compression = algorithm
         
         await update.message.reply_text(
             f"✅ Compression algorithm set to **{algorithm.upper()}**\n\n"
@@ -297,40 +464,16 @@ Need more help? Contact the bot administrator."""
     async def settings_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /settings command."""
         user_id = update.effective_user.id
-        user_prefs = self.user_settings.get(user_id, {})
-        
-        settings_text = f"""
-⚙️ **Your Settings**
-
-**Compression Algorithm:** {user_prefs.get('compression', self.config.DEFAULT_COMPRESSION).upper()}
-**Compression Level:** {self.config.COMPRESSION_LEVEL}/9
-**Max File Size:** {format_file_size(self.config.MAX_FILE_SIZE)}
-**Temp Directory:** {self.config.TEMP_DIR}
-
-**Storage:**
-• Mega.nz Account: Connected ✅
-• Telegram Channel: {'Connected' if self.config.STORAGE_CHANNEL_ID else 'Not configured'}
-
-**Usage Tips:**
-• ZIP: Best for mixed file types
-• GZIP: Fastest compression
-• LZMA: Best compression ratio
-
-Use `/compress <algorithm>` to change compression.
-        """
+        user_prefs = self.user_settings.get(user_id, _DEFAULT_PREFS)
         
-        keyboard = [
-            [InlineKeyboardButton("📋 My Files", callback_data="list_files")],
-            [InlineKeyboardButton("🗜️ ZIP", callback_data="compress_zip")],
-            [InlineKeyboardButton("⚡ GZIP", callback_data="compress_gzip")],
-            [InlineKeyboardButton("🎯 LZMA", callback_data="compress_lzma")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        settings_text = self._settings_template.substitute(
+            compression=(user_prefs.compression or self.config.DEFAULT_COMPRESSION).upper()
+        )
         
         await update.message.reply_text(
             settings_text,
             parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
+            reply_markup=self._settings_markup
         )
     
     async def handle_file_upload(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -355,97 +498,174 @@ Use `/compress <algorithm>` to change compression.
             await update.message.reply_text("❌ Please send a valid file.")
             return
         
+        # Formatted once; every status message repeats it
+        size_text = format_file_size(file_obj.file_size)
+        
         # Check file size
         if file_obj.file_size > self.config.MAX_FILE_SIZE:
             await update.message.reply_text(
                 f"❌ File too large! Maximum size: {format_file_size(self.config.MAX_FILE_SIZE)}\n"
-                f"Your file: {format_file_size(file_obj.file_size)}"
+                f"Your file: {size_text}"
             )
             return
         
-        # Get filename
-        if hasattr(file_obj, 'file_name') and file_obj.file_name:
-            original_filename = file_obj.file_name
-        elif file_type == "photo":
-            original_filename = f"photo_{int(time.time())}.jpg"
-        elif file_type == "video":
-            original_filename = f"video_{int(time.time())}.mp4"
-        elif file_type == "audio":
-            original_filename = f"audio_{int(time.time())}.mp3"
-        else:
-            original_filename = f"file_{int(time.time())}"
+        # Get filename (photos never carry one; other media may not)
+        original_filename = getattr(file_obj, 'file_name', None)
+        if not original_filename:
+            prefix, extension = _FALLBACK_NAMES.get(file_type, ("file", ""))
+            original_filename = f"{prefix}_{int(time.time())}{extension}"
+        
+        # Tracked so shutdown can cancel it (uploads run as their own tasks)
+        task = asyncio.current_task()
+        self._upload_tasks.add(task)
+        task.add_done_callback(self._upload_tasks.discard)
         
         # Show initial progress
+        queued = self._upload_slots.locked()
         progress_msg = await update.message.reply_text(
             f"📤 **Processing: {original_filename}**\n"
-            f"Size: {format_file_size(file_obj.file_size)}\n"
-            f"Status: Downloading from Telegram..."
+            f"Size: {size_text}\n"
+            f"Status: {'Queued, waiting for other uploads...' if queued else 'Downloading from Telegram...'}"
         )
         
-        try:
-            # Download file from Telegram
-            if file_obj.file_size < 20 * 1024 * 1024:  # 20MB - use Bot API
-                telegram_file = await context.bot.get_file(file_obj.file_id)
-                temp_path = os.path.join(self.config.TEMP_DIR, f"temp_{user_id}_{int(time.time())}")
-                await telegram_file.download_to_drive(temp_path)
-            else:
-                # Use Telethon for larger files
-                temp_path = os.path.join(self.config.TEMP_DIR, f"temp_{user_id}_{int(time.time())}")
-                await self.telethon_client.download_media(
-                    await self.telethon_client.get_messages(update.effective_chat.id, ids=update.message.message_id),
-                    temp_path
+        async with self._upload_slots:
+            if queued:
+                await self._throttled_edit(
+                    progress_msg,
+                    f"📤 **Processing: {original_filename}**\n"
+                    f"Size: {size_text}\n"
+                    f"Status: Downloading from Telegram..."
                 )
             
-            await progress_msg.edit_text(
-                f"📤 **Processing: {original_filename}**\n"
-                f"Size: {format_file_size(file_obj.file_size)}\n"
-                f"Status: Compressing file..."
-            )
-            
-            # Compress file
-            compression_algo = self.user_settings.get(user_id, {}).get('compression', self.config.DEFAULT_COMPRESSION)
-            compressed_path = await self.compression_manager.compress_file(
-                temp_path, compression_algo, self.config.COMPRESSION_LEVEL
-            )
-            
-            # Calculate compression ratio
-            compressed_size = os.path.getsize(compressed_path)
-            compression_ratio = calculate_compression_ratio(file_obj.file_size, compressed_size)
-            
-            await progress_msg.edit_text(
-                f"📤 **Processing: {original_filename}**\n"
-                f"Original: {format_file_size(file_obj.file_size)}\n"
-                f"Compressed: {format_file_size(compressed_size)} ({compression_ratio:.1f}% reduction)\n"
-                f"Status: Uploading to Mega.nz..."
-            )
+            temp_path = None
+            compressed_path = None
             
-            # Upload to Mega.nz
-            file_id = generate_file_id()
-            mega_link = await self.storage_manager.upload_file(
-                compressed_path, file_id, user_id, {
-                    'original_name': original_filename,
-                    'original_size': file_obj.file_size,
-                    'compressed_size': compressed_size,
-                    'compression_algo': compression_algo,
-                    'compression_ratio': compression_ratio,
-                    'file_type': file_type
-                }
-            )
-            
-            # Success message
-            storage_methods = []
-            if self.config.STORAGE_CHANNEL_ID:
-                storage_methods.append("⚡ Telegram Channel")
-            if self.config.MEGA_EMAIL and self.config.MEGA_PASSWORD:
-                storage_methods.append("☁️ Mega.nz")
-            storage_methods.append("💾 Local Backup")
-            storage_info = " + ".join(storage_methods)
+            try:
+                file_id = generate_file_id()
+                # Named after the unique file ID: uploads run concurrently, and an
+                # album delivers several files within the same second
+                temp_name = f"temp_{user_id}_{file_id}"
+                temp_path = os.path.join(self.config.TEMP_DIR, temp_name)
+                file_data = None
+                stream = None
+                compression_algo = self.user_settings.get(user_id, _DEFAULT_PREFS).compression or self.config.DEFAULT_COMPRESSION
+                
+                # Download file from Telegram over MTProto; this skips the Bot API's
+                # getFile round trip and keeps transfers out of its connection pool
+                message = await self.telethon_client.get_messages(update.effective_chat.id, ids=update.message.message_id)
+                if file_obj.file_size < IN_MEMORY_UPLOAD_LIMIT:
+                    file_data = await self.storage_manager.download_message(message, bytes)
+                else:
+                    if not self.compression_manager.has_compressed_extension(original_filename):
+                        # Compress while downloading, straight into the storage location
+                        compressed_path = self.storage_manager.get_stored_file_path(
+                            file_id, user_id, f"{temp_name}.{compression_algo}"
+                        )
+                        stream = self.compression_manager.open_compress_stream(
+                            compression_algo, self.config.COMPRESSION_LEVEL, compressed_path,
+                            arcname=temp_name, size_hint=file_obj.file_size
+                        )
+                    
+                    if stream is not None:
+                        try:
+                            await self.storage_manager.download_message(message, stream)
+                            await stream.close()
+                        except BaseException:
+                            stream.abort()
+                            raise
+                        
+                        if stream.algorithm == 'none':
+                            # The content turned out to be compressed already; it was stored as-is
+                            compression_algo = 'none'
+                            stored_path = self.storage_manager.get_stored_file_path(file_id, user_id, temp_name)
+                            os.replace(compressed_path, stored_path)
+                            compressed_path = stored_path
+                    else:
+                        # Telethon may add an extension, so use the path it returns
+                        temp_path = await self.storage_manager.download_message(message, temp_path)
+                
+                if stream is None:
+                    await self._throttled_edit(
+                        progress_msg,
+                        f"📤 **Processing: {original_filename}**\n"
+                        f"Size: {size_text}\n"
+                        f"Status: Compressing file..."
+                    )
+                    
+                    # Compress straight into the storage backup location (no compressed temp file)
+                    if file_data is not None:
+                        compress = self.compression_manager.should_compress_bytes(file_data, original_filename)
+                    else:
+                        compress = self.compression_manager.should_compress(temp_path, original_filename)
+                    
+                    if not compress:
+                        # Already-compressed media: store as-is instead of running a codec over it
+                        compression_algo = 'none'
+                    
+                    compressed_path = self.storage_manager.get_stored_file_path(
+                        file_id, user_id, temp_name if compression_algo == 'none' else f"{temp_name}.{compression_algo}"
+                    )
+                    
+                    if file_data is not None:
+                        # Small files are compressed in memory and written to storage once
+                        if compress:
+                            file_data = await self.compression_manager.compress_bytes(
+                                file_data, compression_algo, self.config.COMPRESSION_LEVEL, arcname=temp_name
+                            )
+                        # Off the event loop; other uploads and commands keep running meanwhile
+                        await asyncio.to_thread(Path(compressed_path).write_bytes, file_data)
+                    elif compress:
+                        await self.compression_manager.compress_file(
+                            temp_path, compression_algo, self.config.COMPRESSION_LEVEL,
+                            output_path=compressed_path
+                        )
+                    else:
+                        os.replace(temp_path, compressed_path)
+                
+                # Calculate compression ratio
+                compressed_size = os.path.getsize(compressed_path)
+                compression_ratio = calculate_compression_ratio(file_obj.file_size, compressed_size)
+                compressed_text = format_file_size(compressed_size)
+                
+                await self._throttled_edit(
+                    progress_msg,
+                    f"📤 **Processing: {original_filename}**\n"
+                    f"Original: {size_text}\n"
+                    f"Compressed: {compressed_text} ({compression_ratio:.1f}% reduction)\n"
+                    f"Status: Uploading to Mega.nz..."
+                )
                 
-            success_text = f"""✅ Upload Complete!
+                # Upload to Mega.nz
+                mega_link = await self.storage_manager.upload_file(
+                    compressed_path, file_id, user_id, {
+                        'original_name': original_filename,
+                        'original_size': file_obj.file_size,
+                        'compressed_size': compressed_size,
+                        'compression_algo': compression_algo,
+                        'compression_ratio': compression_ratio,
+                        'file_type': file_type
+                    }
+                )
+                compressed_path = None  # Now the tracked local backup; keep it on later errors
+                
+                # Success message, listing where the file actually ended up (an
+                # upload may fail, and without KEEP_LOCAL_BACKUP the local copy
+                # is dropped once the channel has the file)
+                stored = self.storage_manager.metadata[file_id]
+                storage_methods = []
+                if stored.telegram_message_id:
+                    storage_methods.append("⚡ Telegram Channel")
+                if stored.mega_link:
+                    storage_methods.append("☁️ Mega.nz")
+                if stored.stored_file_path:
+                    storage_methods.append("💾 Local Backup")
+                storage_info = " + ".join(storage_methods)
+                    
+                success_text = f"""✅ Upload Complete!
 
 📁 File: {original_filename}
 🆔 ID: {file_id}
-📊 Size: {format_file_size(file_obj.file_size)} → {format_file_size(compressed_size)}
+📊 Size: {size_text} → {compressed_text}
 🗜️ Compression: {compression_ratio:.1f}% reduction ({compression_algo.upper()})
 🔗 Storage: {storage_info}
 
@@ -453,28 +673,62 @@ Commands:
 • /download {file_id} - Download file
 • /delete {file_id} - Delete file
 • /list - View all files"""
+                
+                await self._settle_edits(progress_msg)
+                await _with_retry(lambda: progress_msg.edit_text(success_text))
+                        
+            except Exception as e:
+                logger.error(f"File upload error: {e}")
+                await self._settle_edits(progress_msg)
+                await _with_retry(lambda: progress_msg.edit_text(f"❌ Upload failed: {str(e)}"))
             
-            await progress_msg.edit_text(success_text)
-            
-            # Cleanup temp files
-            for temp_file in [temp_path, compressed_path]:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except:
-                    pass
-                    
-        except Exception as e:
-            logger.error(f"File upload error: {e}")
-            await progress_msg.edit_text(f"❌ Upload failed: {str(e)}")
-            
-            # Cleanup on error
-            for temp_file in [temp_path, compressed_path] if 'compressed_path' in locals() else [temp_path] if 'temp_path' in locals() else []:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except:
-                    pass
+            finally:
+                # Runs even if the reply fails or the upload is cancelled; after a
+                # successful upload compressed_path is None (it's the local backup)
+                quiet_unlink(temp_path)
+                quiet_unlink(compressed_path)
+    
+    async def _throttled_edit(self, message, text, min_interval: float = PROGRESS_EDIT_INTERVAL):
+        """
+        Edit a progress message in the background without waiting for Telegram.
+        Edits closer than min_interval to the previous one for the same message
+        are dropped.
+        """
+        key = (message.chat_id, message.message_id)
+        now = time.monotonic()
+        if now - self._last_edit.get(key, 0.0) < min_interval:
+            return
+        
+        self._last_edit[key] = now
+        previous = self._pending_edits.get(key)
+        self._pending_edits[key] = asyncio.create_task(self._chain_edit(previous, message, text))
+    
+    async def _chain_edit(self, previous, message, text):
+        """Apply a progress edit after the previous one for the same message."""
+        if previous:
+            await previous
+        await self._update_progress(message, text)
+    
+    async def cancel_uploads(self, grace: float):
+        """
+        Give in-flight uploads up to grace seconds to finish, then cancel the
+        rest. Their temp files are removed by the upload handler's cleanup.
+        """
+        if not self._upload_tasks:
+            return
+        
+        _, pending = await asyncio.wait(self._upload_tasks, timeout=grace)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    
+    async def _settle_edits(self, message):
+        """Wait for background edits of a message so a final edit can't be overwritten."""
+        key = (message.chat_id, message.message_id)
+        self._last_edit.pop(key, None)
+        pending = self._pending_edits.pop(key, None)
+        if pending:
+            await pending
     
     async def _update_progress(self, message, text):
         """Update progress message safely."""
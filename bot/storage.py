@@ -5,55 +5,272 @@ Note: Using local storage as fallback until Mega.nz library compatibility is res
 """
 
 import asyncio
+import concurrent.futures
+import dataclasses
+import itertools
 import json
 import logging
 import os
-import shutil
+import tempfile
+import threading
 import time
+from collections import defaultdict
+from dataclasses import dataclass
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple, Callable
-import requests
+
+from telethon import helpers
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.types import InputFileBig
 
 from .compression import CompressionManager
-from .utils import generate_file_id
+from .utils import AdaptiveConcurrencyLimiter, fast_copy, generate_file_id, iter_files, quiet_unlink
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# mega.py is synchronous; each MegaUploader runs its calls on a pool of this
+# many threads, so multi-GB uploads neither block the event loop nor tie up
+# the default executor
+MEGA_WORKERS = 4
+
+# Seconds between background Mega re-logins, keeping the session fresh
+# without making an upload pay for the login
+MEGA_SESSION_REFRESH_INTERVAL = 45 * 60
+
+# A saved Mega session younger than this is reused at startup instead of
+# running the full login handshake again
+MEGA_SESSION_MAX_AGE = 24 * 3600
+
+# Files below this size go to the channel through Telethon's own upload;
+# larger ones are Telegram "big files", uploaded in parallel parts. Both use
+# 512 KiB, the largest part Telegram accepts, to keep round trips down
+SMALL_UPLOAD_THRESHOLD = 10 * 1024 * 1024
+UPLOAD_PART_SIZE = 512 * 1024
+CHANNEL_UPLOAD_WORKERS = 8
+
+# Media at least this large is downloaded as parallel parts of DOWNLOAD_PART_SIZE
+# (the largest part Telegram serves per request)
+PARALLEL_DOWNLOAD_THRESHOLD = 10 * 1024 * 1024
+DOWNLOAD_PART_SIZE = 512 * 1024
+
+# Telegram accepts at most this many message IDs per delete_messages call
+DELETE_BATCH_SIZE = 100
+
+# Seconds between full storage scans correcting the usage counters
+STORAGE_RESCAN_INTERVAL = 3600
+
+# Delay before unsaved metadata changes are written, so bursts coalesce
+METADATA_FLUSH_DELAY = 0.5
+
+def _dump_json(obj) -> bytes:
+    """Serialize to compact JSON bytes. Dataclass records become objects."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), default=dataclasses.asdict).encode('utf-8')
+
+def _load_json(data: bytes):
+    """Parse JSON bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _upload_timestamp(metadata: Dict) -> float:
+    """Upload time as a Unix timestamp; older entries only store an ISO string."""
+    if 'upload_ts' in metadata:
+        return metadata['upload_ts']
+    try:
+        return datetime.fromisoformat(metadata['upload_date']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+@dataclass(slots=True)
+class FileMeta:
+    """Stored file record."""
+    file_id: str
+    user_id: int
+    stored_file_path: Optional[str] = None
+    telegram_message_id: Optional[int] = None
+    channel_link: Optional[str] = None
+    mega_link: Optional[str] = None
+    public_link: Optional[str] = None
+    storage_type: str = 'local'
+    upload_ts: float = 0.0
+    original_name: str = 'Unknown'
+    original_size: int = 0
+    compressed_size: int = 0
+    compression_ratio: float = 0.0
+    compression_algo: Optional[str] = None
+    file_type: Optional[str] = None
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'FileMeta':
+        """Build a record from its JSON form, ignoring unknown keys."""
+        fields = {name: data[name] for name in cls.__slots__ if name in data}
+        fields['upload_ts'] = _upload_timestamp(data)
+        return cls(**fields)
+    
+    @property
+    def upload_date(self) -> str:
+        """Upload time as an ISO string, formatted only when it is displayed."""
+        return datetime.fromtimestamp(self.upload_ts).isoformat() if self.upload_ts else 'Unknown'
+
 class MegaUploader:
     """Handles Mega.nz file uploads as additional cloud storage."""
     
-    def __init__(self, email: str, password: str):
+    _mega_cls = None
+    
+    def __init__(self, email: str, password: str, session_file: Optional[str] = None):
         self.email = email
         self.password = password
+        self.session_file = session_file
         self.mega = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Owned by this uploader, so closing it leaves other instances working
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=MEGA_WORKERS, thread_name_prefix='mega')
+        # Concurrent uploads back off while Mega is failing and recover as it succeeds
+        self._limiter = AdaptiveConcurrencyLimiter(max_concurrency=MEGA_WORKERS, initial_concurrency=2)
+    
+    @classmethod
+    def _get_mega(cls):
+        """Import mega.py on first use, so it costs nothing when Mega is not configured."""
+        if cls._mega_cls is None:
+            from mega import Mega
+            cls._mega_cls = Mega
+        return cls._mega_cls
         
+    async def _login(self):
+        """Log in to Mega.nz and return the session."""
+        # Imported lazily to avoid errors if not installed
+        mega = self._get_mega()()
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(
+            self._executor, mega.login, self.email, self.password
+        )
+        if self.session_file:
+            try:
+                await loop.run_in_executor(self._executor, self._save_session, session)
+            except OSError as e:
+                logger.warning(f"Could not save Mega.nz session: {e}")
+        return self._serialize_api_requests(session)
+    
+    async def _resume_session(self):
+        """Return the saved session if it is recent and still accepted, else None."""
+        if not self.session_file:
+            return None
+        try:
+            session = await asyncio.get_running_loop().run_in_executor(self._executor, self._load_session)
+        except Exception as e:
+            logger.info(f"Saved Mega.nz session not usable, logging in: {e}")
+            return None
+        return session and self._serialize_api_requests(session)
+    
+    def _load_session(self):
+        """Rebuild a session from the saved one, checking it with an API call."""
+        try:
+            if time.time() - os.path.getmtime(self.session_file) >= MEGA_SESSION_MAX_AGE:
+                return None
+            with open(self.session_file, 'rb') as f:
+                saved = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        if saved.get('email') != self.email:
+            return None
+        
+        mega = self._get_mega()()
+        mega.sid = saved['sid']
+        mega.master_key = saved['master_key']
+        # What login() does after authenticating; fails if the session expired
+        mega._trash_folder_node_id = mega.get_node_by_type(4)[0]
+        return mega
+    
+    def _save_session(self, session):
+        """Write the session ID and master key for the next start, readable only by us."""
+        data = json.dumps({
+            'email': self.email,
+            'sid': session.sid,
+            'master_key': list(session.master_key)
+        }).encode()
+        # mkstemp creates the file with mode 0600
+        fd, temp_file = tempfile.mkstemp(prefix='mega_', dir=os.path.dirname(self.session_file) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_file, self.session_file)
+        except BaseException:
+            quiet_unlink(temp_file)
+            raise
+    
+    @staticmethod
+    def _serialize_api_requests(session):
+        """
+        Make a session's API commands run one at a time. Each command takes
+        the next request id from an unlocked counter, so concurrent uploads
+        could send duplicate ids; the chunk transfers themselves don't go
+        through here and stay parallel.
+        """
+        lock = threading.Lock()
+        api_request = session._api_request
+        
+        def locked_api_request(*args, **kwargs):
+            with lock:
+                return api_request(*args, **kwargs)
+        
+        session._api_request = locked_api_request
+        return session
+    
     async def initialize(self):
         """Initialize Mega.nz connection."""
         try:
-            # Import mega.py here to avoid errors if not installed
-            from mega import Mega
-            
-            mega = Mega()
-            self.mega = mega.login(self.email, self.password)
+            self.mega = await self._resume_session() or await self._login()
             logger.info("Mega.nz connection initialized successfully")
-            return True
         except Exception as e:
             logger.warning(f"Mega.nz initialization failed: {e}")
             return False
+        
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_session())
+        return True
+    
+    async def _refresh_session(self):
+        """Periodically replace the session with a fresh login, off the upload path."""
+        while True:
+            await asyncio.sleep(MEGA_SESSION_REFRESH_INTERVAL)
+            try:
+                self.mega = await self._login()
+                logger.info("Mega.nz session refreshed")
+            except Exception as e:
+                # Keep the current session; the next round tries again
+                logger.warning(f"Mega.nz session refresh failed: {e}")
+    
+    def close(self):
+        """Stop refreshing the session and drop queued Mega work; a running upload finishes."""
+        if self._refresh_task:
+            self._refresh_task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
     
     async def upload_file(self, file_path: str, filename: str) -> Optional[str]:
         """Upload file to Mega.nz and return public link."""
-        if not self.mega:
+        # A refresh may swap the session mid-upload; finish on the one we started with
+        mega = self.mega
+        if not mega:
             return None
             
         try:
             logger.info(f"Uploading {filename} to Mega.nz...")
             
-            # Upload file to Mega
-            uploaded_file = self.mega.upload(file_path)
+            loop = asyncio.get_running_loop()
             
-            # Get public link
-            public_link = self.mega.get_upload_link(uploaded_file)
+            async with self._limiter:
+                # Upload file to Mega
+                uploaded_file = await loop.run_in_executor(self._executor, mega.upload, file_path)
+                
+                # Get public link
+                public_link = await loop.run_in_executor(self._executor, mega.get_upload_link, uploaded_file)
             
             logger.info(f"File uploaded to Mega.nz successfully: {public_link}")
             return public_link
@@ -63,19 +280,53 @@ class MegaUploader:
             return None
 
 class MegaStorageManager:
+    _CAPTION_TEMPLATE = "File ID: {fid}\nUser: {uid}\nOriginal: {name}".format
+    
     def __init__(self, config):
         self.config = config
         self.compression_manager = CompressionManager(config)
         self.metadata_file = os.path.join(config.TEMP_DIR, 'file_metadata.json')
+        # Changes since the last snapshot, one JSON line each, replayed on load
+        self.metadata_log = self.metadata_file + '.log'
+        self._snapshot_size = 0
+        self._log_size = 0
         self.metadata = self._load_metadata()
+        self._by_user = self._build_user_index()
+        self._pending_log: List[bytes] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._metadata_lock = asyncio.Lock()
+        # Local usage, kept current on upload/delete and corrected by periodic rescans
+        self._total_files = 0
+        self._total_bytes = 0
+        for metadata in self.metadata.values():
+            self._track_usage(metadata, 1)
+        self._last_full_scan_ts = 0.0
+        self._recount_task: Optional[asyncio.Task] = None
+        self._ensured_dirs = set()
         self.storage_dir = os.path.join(config.TEMP_DIR, 'file_storage')
-        os.makedirs(self.storage_dir, exist_ok=True)
+        self._ensure_dir(self.storage_dir)
+        # User folders from earlier runs are already there
+        with os.scandir(self.storage_dir) as entries:
+            self._ensured_dirs.update(entry.path for entry in entries if entry.is_dir())
         self.telethon_client = None
-        self.mega_uploader = MegaUploader(config.MEGA_EMAIL, config.MEGA_PASSWORD) if config.MEGA_EMAIL and config.MEGA_PASSWORD else None
+        self._channel_peer = None
+        # Channel links use the ID without its "-100" prefix
+        self._channel_link_prefix = f"t.me/c/{str(config.STORAGE_CHANNEL_ID)[4:]}/" if config.STORAGE_CHANNEL_ID else None
+        self.mega_uploader = MegaUploader(
+            config.MEGA_EMAIL, config.MEGA_PASSWORD,
+            session_file=os.path.join(config.TEMP_DIR, 'mega_session.json')
+        ) if config.MEGA_EMAIL and config.MEGA_PASSWORD else None
         
     def set_telethon_client(self, client):
         """Set Telethon client for channel storage."""
         self.telethon_client = client
+        self._channel_peer = None
+    
+    async def _get_channel_peer(self):
+        """Resolve the storage channel's input peer once and reuse it for every request."""
+        if self._channel_peer is None:
+            self._channel_peer = await self.telethon_client.get_input_entity(self.config.STORAGE_CHANNEL_ID)
+        return self._channel_peer
         
     async def initialize(self):
         """Initialize storage system."""
@@ -114,49 +365,38 @@ class MegaStorageManager:
             Public download link
         """
         try:
-            # Try uploading to multiple storage locations
-            telegram_message_id = None
-            channel_link = None
-            mega_link = None
-            
-            # Upload to Telegram channel for instant access
-            if self.config.STORAGE_CHANNEL_ID and self.telethon_client:
-                try:
-                    logger.info(f"Uploading {file_path} to Telegram channel for instant access")
-                    
-                    # Upload to storage channel
-                    message = await self.telethon_client.send_file(
-                        self.config.STORAGE_CHANNEL_ID,
-                        file_path,
-                        caption=f"File ID: {file_id}\nUser: {user_id}\nOriginal: {metadata.get('original_name', 'unknown')}"
-                    )
-                    
-                    telegram_message_id = message.id
-                    channel_link = f"t.me/c/{str(self.config.STORAGE_CHANNEL_ID)[4:]}/{message.id}"
-                    logger.info(f"File uploaded to Telegram channel successfully: Message ID {telegram_message_id}")
-                    
-                except Exception as channel_error:
-                    logger.warning(f"Channel upload failed: {channel_error}")
-            
-            # Also upload to Mega.nz for cloud backup
-            if self.mega_uploader and self.mega_uploader.mega:
-                try:
-                    mega_link = await self.mega_uploader.upload_file(
-                        file_path, 
-                        metadata.get('original_name', os.path.basename(file_path))
-                    )
-                    if mega_link:
-                        logger.info("File uploaded to Mega.nz successfully")
-                except Exception as mega_error:
-                    logger.warning(f"Mega.nz upload failed: {mega_error}")
-            
-            # Always keep local backup
-            user_folder = os.path.join(self.storage_dir, f"user_{user_id}")
-            os.makedirs(user_folder, exist_ok=True)
-            
-            stored_file_path = os.path.join(user_folder, f"{file_id}_{os.path.basename(file_path)}")
-            logger.info(f"Creating local backup: {stored_file_path}")
-            shutil.copy2(file_path, stored_file_path)
+            original_name = metadata.get('original_name') or os.path.basename(file_path)
+            
+            # Upload to all storage locations concurrently; channel and Mega
+            # failures are logged and tolerated, the local backup is required.
+            # Without KEEP_LOCAL_BACKUP the backup waits to see whether the
+            # channel upload made it unnecessary.
+            keep_local = self.config.KEEP_LOCAL_BACKUP
+            channel_result, mega_link, stored_file_path = await asyncio.gather(
+                self._upload_telegram(file_path, file_id, user_id, original_name),
+                self._upload_mega(file_path, original_name),
+                self._local_backup(file_path, file_id, user_id) if keep_local else asyncio.sleep(0),
+                return_exceptions=True
+            )
+            
+            if isinstance(stored_file_path, BaseException):
+                raise stored_file_path
+            if isinstance(channel_result, BaseException):
+                logger.warning(f"Channel upload failed: {channel_result}")
+                channel_result = None
+            if isinstance(mega_link, BaseException):
+                logger.warning(f"Mega.nz upload failed: {mega_link}")
+                mega_link = None
+            
+            telegram_message_id, channel_link = channel_result or (None, None)
+            
+            if not keep_local:
+                if telegram_message_id:
+                    # Channel-only: drop a copy already written into storage
+                    if self._in_user_folder(file_path, user_id):
+                        await asyncio.to_thread(quiet_unlink, file_path)
+                else:
+                    stored_file_path = await self._local_backup(file_path, file_id, user_id)
             
             # Determine primary download method (prefer Telegram channel for instant access)
             if telegram_message_id:
@@ -170,7 +410,8 @@ class MegaStorageManager:
                 storage_type = "local"
             
             # Store metadata with all storage locations
-            file_metadata = {
+            file_metadata = FileMeta.from_dict({
+                **metadata,
                 'file_id': file_id,
                 'user_id': user_id,
                 'stored_file_path': stored_file_path,
@@ -179,9 +420,9 @@ class MegaStorageManager:
                 'mega_link': mega_link,
                 'public_link': public_link,
                 'storage_type': storage_type,
-                'upload_date': datetime.now().isoformat(),
-                **metadata
-            }
+                'upload_ts': time.time(),
+                'original_name': original_name
+            })
             
             await self._store_file_metadata(file_id, file_metadata)
             
@@ -192,6 +433,158 @@ class MegaStorageManager:
             logger.error(f"Upload failed: {e}")
             raise
     
+    async def _upload_telegram(self, file_path: str, file_id: str, user_id: int, original_name: str) -> Optional[Tuple[int, str]]:
+        """Upload to the storage channel. Returns (message_id, channel_link) or None if not configured."""
+        if not (self.config.STORAGE_CHANNEL_ID and self.telethon_client):
+            return None
+        
+        logger.info(f"Uploading {file_path} to Telegram channel for instant access")
+        
+        # Upload to storage channel
+        if os.path.getsize(file_path) < SMALL_UPLOAD_THRESHOLD:
+            file = file_path
+        else:
+            file = await self.upload_parts(file_path)
+        message = await self.telethon_client.send_file(
+            await self._get_channel_peer(),
+            file,
+            caption=self._CAPTION_TEMPLATE(fid=file_id, uid=user_id, name=original_name),
+            part_size_kb=UPLOAD_PART_SIZE // 1024
+        )
+        
+        channel_link = self._channel_link_prefix + str(message.id)
+        logger.info(f"File uploaded to Telegram channel successfully: Message ID {message.id}")
+        return message.id, channel_link
+    
+    async def upload_parts(self, file_path: str) -> InputFileBig:
+        """
+        Upload a big file's parts with several requests in flight. Telethon's
+        own upload waits for each part before sending the next; overlapping
+        them hides the per-request round trip. Flood waits are slept through
+        by Telethon itself.
+        """
+        size = os.path.getsize(file_path)
+        total_parts = -(-size // UPLOAD_PART_SIZE)
+        upload_id = helpers.generate_random_long()
+        parts = iter(range(total_parts))
+        
+        async def worker(fd: int):
+            # Workers share one iterator, so each part is taken exactly once
+            for part in parts:
+                data = await asyncio.to_thread(os.pread, fd, UPLOAD_PART_SIZE, part * UPLOAD_PART_SIZE)
+                if not await self.telethon_client(SaveBigFilePartRequest(upload_id, part, total_parts, data)):
+                    raise IOError(f"Telegram rejected upload part {part}")
+        
+        fd = os.open(file_path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            async with asyncio.TaskGroup() as group:
+                for _ in range(min(CHANNEL_UPLOAD_WORKERS, total_parts)):
+                    group.create_task(worker(fd))
+        finally:
+            os.close(fd)
+        
+        return InputFileBig(upload_id, total_parts, os.path.basename(file_path))
+    
+    async def download_message(self, message, out):
+        """
+        Download a message's media into out: a file path, bytes (to get the
+        content in memory, as with Telethon), or a sink whose write() is
+        awaitable. Big files are fetched as parallel parts. Returns the path
+        written to when out is a path, and the content when out is bytes.
+        """
+        size = message.file.size if message.file else 0
+        if size < PARALLEL_DOWNLOAD_THRESHOLD or self.config.DOWNLOAD_WORKERS <= 1:
+            return await self.telethon_client.download_media(message, out)
+        
+        if out is bytes:
+            buffer = bytearray()
+            
+            async def append(chunk):
+                buffer.extend(chunk)
+            
+            await self._download_parts(message, size, append)
+            return buffer
+        
+        if not isinstance(out, str):
+            await self._download_parts(message, size, out.write)
+            return out
+        
+        try:
+            with open(out, 'wb') as f:
+                await self._download_parts(message, size, lambda chunk: asyncio.to_thread(f.write, chunk))
+        except BaseException:
+            quiet_unlink(out)
+            raise
+        return out
+    
+    async def _download_parts(self, message, size: int, write):
+        """
+        Fetch media in parts with several requests in flight, passing them to
+        write() in file order. Worker i fetches every n-th part and keeps a
+        couple queued, so the writer rarely waits on a round trip.
+        """
+        total_parts = -(-size // DOWNLOAD_PART_SIZE)
+        workers = min(self.config.DOWNLOAD_WORKERS, total_parts)
+        queues = [asyncio.Queue(maxsize=2) for _ in range(workers)]
+        
+        async def worker(index: int):
+            async for chunk in self.telethon_client.iter_download(
+                message,
+                offset=index * DOWNLOAD_PART_SIZE,
+                stride=workers * DOWNLOAD_PART_SIZE,
+                limit=len(range(index, total_parts, workers)),
+                chunk_size=DOWNLOAD_PART_SIZE,
+                request_size=DOWNLOAD_PART_SIZE,
+                file_size=size
+            ):
+                await queues[index].put(chunk)
+            # Only read if this worker came up short
+            await queues[index].put(None)
+        
+        async with asyncio.TaskGroup() as group:
+            for index in range(workers):
+                group.create_task(worker(index))
+            for part in range(total_parts):
+                chunk = await queues[part % workers].get()
+                if chunk is None:
+                    raise IOError(f"Download ended early at part {part} of {total_parts}")
+                await write(chunk)
+    
+    async def _upload_mega(self, file_path: str, original_name: str) -> Optional[str]:
+        """Upload to Mega.nz for cloud backup. Returns the public link or None."""
+        if not (self.mega_uploader and self.mega_uploader.mega):
+            return None
+        
+        mega_link = await self.mega_uploader.upload_file(file_path, original_name)
+        if mega_link:
+            logger.info("File uploaded to Mega.nz successfully")
+        return mega_link
+    
+    async def _local_backup(self, file_path: str, file_id: str, user_id: int) -> str:
+        """Keep a local backup of the file. Returns the stored path."""
+        if self._in_user_folder(file_path, user_id):
+            # Already written straight into storage (see get_stored_file_path)
+            return file_path
+        
+        user_folder = self._get_user_folder(user_id)
+        stored_file_path = os.path.join(user_folder, f"{file_id}_{os.path.basename(file_path)}")
+        logger.info(f"Creating local backup: {stored_file_path}")
+        await asyncio.to_thread(fast_copy, file_path, stored_file_path)
+        return stored_file_path
+    
+    def _in_user_folder(self, file_path: str, user_id: int) -> bool:
+        """Check whether file_path lives directly in the user's storage folder."""
+        return os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(self._get_user_folder(user_id))
+    
+    def get_stored_file_path(self, file_id: str, user_id: int, filename: str) -> str:
+        """
+        Get the local backup path for a file, so producers can write there directly
+        instead of going through a temp file that upload_file would copy.
+        """
+        return os.path.join(self._get_user_folder(user_id), f"{file_id}_{filename}")
+    
     async def download_and_decompress(self, file_id: str, user_id: int, progress_callback: Optional[Callable] = None) -> Optional[Tuple[str, str, int]]:
         """
         Download and decompress a file from storage.
@@ -206,39 +599,101 @@ class MegaStorageManager:
             Tuple of (decompressed_file_path, original_filename, file_size) or None if not found
         """
         # Get file metadata
-        file_metadata = await self._get_file_metadata(file_id, user_id)
+        file_metadata = self._get_file_metadata(file_id, user_id)
         if not file_metadata:
             return None
         
+        return await self._download_and_decompress(file_id, file_metadata, progress_callback)
+    
+    async def download_many(self, file_ids: List[str], user_id: int) -> List[Optional[Tuple[str, str, int]]]:
+        """
+        Download and decompress several files concurrently. The channel messages
+        are fetched in a single request.
+        
+        Returns:
+            One (decompressed_file_path, original_filename, file_size) tuple per
+            file ID, or None where the file is not found or the download failed
+        """
+        metadatas = [self._get_file_metadata(file_id, user_id) for file_id in file_ids]
+        
+        messages = {}
+        message_ids = [m.telegram_message_id for m in metadatas if m and m.telegram_message_id]
+        if message_ids and self.config.STORAGE_CHANNEL_ID and self.telethon_client:
+            try:
+                fetched = await self.telethon_client.get_messages(await self._get_channel_peer(), ids=message_ids)
+                messages = {message.id: message for message in fetched if message}
+            except Exception as e:
+                logger.warning(f"Batched channel lookup failed, fetching individually: {e}")
+        
+        async def download_one(file_id: str, file_metadata: Optional[FileMeta]):
+            if not file_metadata:
+                return None
+            try:
+                return await self._download_and_decompress(
+                    file_id, file_metadata, message=messages.get(file_metadata.telegram_message_id)
+                )
+            except Exception as e:
+                logger.error(f"Download of {file_id} failed: {e}")
+                return None
+        
+        return await asyncio.gather(*(download_one(file_id, m) for file_id, m in zip(file_ids, metadatas)))
+    
+    async def _download_and_decompress(self, file_id: str, file_metadata: FileMeta, progress_callback: Optional[Callable] = None,
+                                       message=None) -> Tuple[str, str, int]:
+        """Fetch a file from the channel (or the local backup) and decompress it."""
         try:
             if progress_callback:
                 await progress_callback(10)
             
-            compressed_file_path = None
+            decompressed_path = None
             
             # Try downloading from Telegram channel first (instant)
-            if (file_metadata.get('telegram_message_id') and 
+            if (file_metadata.telegram_message_id and 
                 self.config.STORAGE_CHANNEL_ID and 
                 self.telethon_client):
                 
                 try:
-                    logger.info(f"Downloading from Telegram channel (instant): Message ID {file_metadata['telegram_message_id']}")
+                    logger.info(f"Downloading from Telegram channel (instant): Message ID {file_metadata.telegram_message_id}")
                     
                     temp_download_path = os.path.join(
                         self.config.TEMP_DIR, 
-                        f"channel_download_{file_id}_{int(time.time())}"
+                        f"channel_download_{file_id}_{generate_file_id()}"
                     )
+                    if message is None:
+                        message = await self.telethon_client.get_messages(
+                            await self._get_channel_peer(), 
+                            ids=file_metadata.telegram_message_id
+                        )
                     
-                    # Download from channel
-                    await self.telethon_client.download_media(
-                        await self.telethon_client.get_messages(
-                            self.config.STORAGE_CHANNEL_ID, 
-                            ids=file_metadata['telegram_message_id']
-                        ),
-                        temp_download_path
+                    # gzip/lzma are decompressed as the chunks arrive; other
+                    # formats are downloaded to a temp file first
+                    stream = self.compression_manager.open_decompress_stream(
+                        file_metadata.compression_algo, temp_download_path
                     )
+                    if stream:
+                        try:
+                            await self.download_message(message, stream)
+                            stream.close()
+                        except BaseException:
+                            stream.abort()
+                            raise
+                        decompressed_path = stream.output_path
+                    elif file_metadata.compression_algo == 'none':
+                        # Telethon may add an extension, so use the path it returns;
+                        # the download itself is the temp file to serve
+                        decompressed_path = await self.download_message(message, temp_download_path)
+                    else:
+                        # Named with the stored extension, which decompress_file reads
+                        # the format from (parallel downloads keep the path as given)
+                        channel_file_path = await self.download_message(
+                            message, f"{temp_download_path}.{file_metadata.compression_algo}"
+                        )
+                        try:
+                            decompressed_path = await self.compression_manager.decompress_file(channel_file_path)
+                        finally:
+                            # Drop the channel download so it stops occupying disk and page cache
+                            quiet_unlink(channel_file_path)
                     
-                    compressed_file_path = temp_download_path
                     logger.info("Downloaded from Telegram channel successfully")
                     
                     if progress_callback:
@@ -247,31 +702,32 @@ class MegaStorageManager:
                 except Exception as channel_error:
                     logger.warning(f"Channel download failed, using local backup: {channel_error}")
             
-            # Fall back to local storage if channel download failed
-            if not compressed_file_path:
-                stored_file_path = file_metadata['stored_file_path']
+            # Fall back to local storage if the channel download failed
+            if decompressed_path is None:
+                stored_file_path = file_metadata.stored_file_path
                 
+                if not stored_file_path:
+                    raise Exception("File is stored in the channel only and the channel download failed")
                 if not os.path.exists(stored_file_path):
                     raise Exception("File not found in any storage location")
                 
-                compressed_file_path = stored_file_path
                 logger.info("Using local backup file")
                 
                 if progress_callback:
                     await progress_callback(60)
-            
-            if progress_callback:
-                await progress_callback(80)
-            
-            # Decompress file
-            decompressed_path = await self.compression_manager.decompress_file(compressed_file_path)
+                
+                # Decompress file (uncompressed media is served as stored)
+                if file_metadata.compression_algo == 'none':
+                    decompressed_path = await asyncio.to_thread(self._temp_copy, stored_file_path)
+                else:
+                    decompressed_path = await self.compression_manager.decompress_file(stored_file_path)
             
             if progress_callback:
                 await progress_callback(100)
             
             # Return file info
-            original_filename = file_metadata['original_name']
-            file_size = file_metadata['original_size']
+            original_filename = file_metadata.original_name
+            file_size = file_metadata.original_size
             
             return decompressed_path, original_filename, file_size
             
@@ -279,70 +735,92 @@ class MegaStorageManager:
             logger.error(f"Download/decompress failed: {e}")
             raise
     
-    async def list_user_files(self, user_id: int) -> List[Dict]:
-        """Get list of files for a user."""
+    async def list_user_files(self, user_id: int, limit: Optional[int] = None) -> List[Dict]:
+        """Get list of files for a user, newest first, optionally only the first limit."""
         user_files = []
         
-        for file_id, metadata in self.metadata.items():
-            if metadata.get('user_id') == user_id:
-                user_files.append({
-                    'file_id': file_id,
-                    'original_name': metadata.get('original_name', 'Unknown'),
-                    'original_size': metadata.get('original_size', 0),
-                    'compressed_size': metadata.get('compressed_size', 0),
-                    'compression_ratio': metadata.get('compression_ratio', 0),
-                    'upload_date': metadata.get('upload_date', 'Unknown'),
-                    'public_link': metadata.get('public_link', '')
-                })
-        
-        # Sort by upload date (newest first)
-        user_files.sort(key=lambda x: x['upload_date'], reverse=True)
+        # The index is kept in upload order, so walking it backwards is newest first
+        for file_id, metadata in itertools.islice(reversed(self._by_user.get(user_id, {}).items()), limit):
+            user_files.append({
+                'file_id': file_id,
+                'original_name': metadata.original_name,
+                'original_size': metadata.original_size,
+                'compressed_size': metadata.compressed_size,
+                'compression_ratio': metadata.compression_ratio,
+                'upload_date': metadata.upload_date,
+                'storage_type': metadata.storage_type,
+                'public_link': metadata.public_link or ''
+            })
+        
         return user_files
     
+    def count_user_files(self, user_id: int) -> int:
+        """Number of files stored for a user."""
+        return len(self._by_user.get(user_id, ()))
+    
     async def delete_file(self, file_id: str, user_id: int) -> bool:
         """Delete a file from storage and metadata."""
-        file_metadata = await self._get_file_metadata(file_id, user_id)
-        if not file_metadata:
-            return False
+        return bool(await self.delete_files([file_id], user_id))
+    
+    async def delete_files(self, file_ids: List[str], user_id: int) -> List[str]:
+        """
+        Delete several files from storage and metadata. Channel messages are
+        removed in batched requests and local copies are unlinked concurrently.
+        
+        Returns:
+            IDs of the files that were deleted
+        """
+        metadatas = [m for m in (self._get_file_metadata(file_id, user_id) for file_id in dict.fromkeys(file_ids)) if m]
+        if not metadatas:
+            return []
         
         try:
+            # Delete from the storage channel
+            message_ids = [m.telegram_message_id for m in metadatas if m.telegram_message_id]
+            if message_ids and self.config.STORAGE_CHANNEL_ID and self.telethon_client:
+                try:
+                    peer = await self._get_channel_peer()
+                    await asyncio.gather(*(
+                        self.telethon_client.delete_messages(peer, message_ids[i:i + DELETE_BATCH_SIZE])
+                        for i in range(0, len(message_ids), DELETE_BATCH_SIZE)
+                    ))
+                except Exception as e:
+                    logger.warning(f"Channel delete failed: {e}")
+            
             # Delete from local storage
-            stored_file_path = file_metadata.get('stored_file_path')
-            if stored_file_path and os.path.exists(stored_file_path):
-                os.remove(stored_file_path)
+            await asyncio.gather(*(
+                asyncio.to_thread(quiet_unlink, m.stored_file_path) for m in metadatas if m.stored_file_path
+            ))
             
             # Remove from metadata
-            if file_id in self.metadata:
-                del self.metadata[file_id]
-                await self._save_metadata()
-            
-            logger.info(f"File deleted successfully: {file_id}")
-            return True
+            deleted = []
+            for metadata in metadatas:
+                if self.metadata.pop(metadata.file_id, None) is None:
+                    continue  # Removed by a concurrent delete
+                self._track_usage(metadata, -1)
+                self._by_user.get(user_id, {}).pop(metadata.file_id, None)
+                await self._save_metadata({'op': 'del', 'id': metadata.file_id})
+                deleted.append(metadata.file_id)
+            
+            logger.info(f"Files deleted successfully: {', '.join(deleted)}")
+            return deleted
             
         except Exception as e:
             logger.error(f"Delete failed: {e}")
-            return False
+            return []
     
     async def get_storage_info(self) -> Dict:
         """Get storage information."""
         try:
-            # Calculate local storage usage
-            total_size = 0
-            file_count = 0
-            
-            for root, dirs, files in os.walk(self.storage_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        total_size += os.path.getsize(file_path)
-                        file_count += 1
-                    except OSError:
-                        pass
+            # Served from the running counters; a stale count triggers a background rescan
+            if (time.time() - self._last_full_scan_ts > STORAGE_RESCAN_INTERVAL and
+                    (self._recount_task is None or self._recount_task.done())):
+                self._recount_task = asyncio.create_task(self._recount())
             
             return {
                 'storage_type': 'local',
-                'total_files': file_count,
-                'total_size': total_size,
+                'total_files': self._total_files,
+                'total_size': self._total_bytes,
                 'storage_dir': self.storage_dir
             }
             
@@ -350,6 +828,23 @@ class MegaStorageManager:
             logger.error(f"Failed to get storage info: {e}")
             return {}
     
+    async def _recount(self):
+        """Walk the storage tree and reset the usage counters to what is on disk."""
+        try:
+            sizes = await asyncio.to_thread(lambda: [size for _, size, _ in iter_files(self.storage_dir)])
+        except Exception as e:
+            logger.error(f"Storage rescan failed: {e}")
+            return
+        self._total_files = len(sizes)
+        self._total_bytes = sum(sizes)
+        self._last_full_scan_ts = time.time()
+    
+    def _track_usage(self, metadata: FileMeta, sign: int):
+        """Add (sign=1) or remove (sign=-1) a file's local copy from the usage counters."""
+        if metadata.stored_file_path:
+            self._total_files += sign
+            self._total_bytes += sign * (metadata.compressed_size or metadata.original_size)
+    
     async def _get_or_create_folder(self, folder_name: str):
         """Get existing folder or create new one."""
         try:
@@ -361,34 +856,162 @@ class MegaStorageManager:
             logger.error(f"Folder operation failed: {e}")
             raise
     
-    async def _store_file_metadata(self, file_id: str, metadata: Dict):
+    def _temp_copy(self, file_path: str) -> str:
+        """Return a path the caller may delete after sending: a hard link to (or copy of) the local backup."""
+        temp_path = os.path.join(self.config.TEMP_DIR, f"serve_{generate_file_id()}_{os.path.basename(file_path)}")
+        try:
+            os.link(file_path, temp_path)
+        except OSError:
+            fast_copy(file_path, temp_path)
+        return temp_path
+    
+    def _get_user_folder(self, user_id: int) -> str:
+        """Get (and create) the local storage folder for a user."""
+        user_folder = os.path.join(self.storage_dir, f"user_{user_id}")
+        self._ensure_dir(user_folder)
+        return user_folder
+    
+    def _ensure_dir(self, path: str):
+        """Create a directory once; later calls skip the makedirs stat walk."""
+        if path not in self._ensured_dirs:
+            os.makedirs(path, exist_ok=True)
+            self._ensured_dirs.add(path)
+    
+    async def _store_file_metadata(self, file_id: str, metadata: FileMeta):
         """Store file metadata."""
+        previous = self.metadata.get(file_id)
+        if previous:
+            self._track_usage(previous, -1)
+        self._track_usage(metadata, 1)
         self.metadata[file_id] = metadata
-        await self._save_metadata()
+        self._by_user[metadata.user_id][file_id] = metadata
+        await self._save_metadata({'op': 'put', 'id': file_id, 'm': metadata})
     
-    async def _get_file_metadata(self, file_id: str, user_id: int) -> Optional[Dict]:
+    def _build_user_index(self) -> Dict[int, Dict[str, FileMeta]]:
+        """Index metadata by user_id, each user's files in upload order."""
+        index = defaultdict(dict)
+        for file_id, metadata in sorted(self.metadata.items(), key=lambda item: item[1].upload_ts):
+            index[metadata.user_id][file_id] = metadata
+        return index
+    
+    def _get_file_metadata(self, file_id: str, user_id: int) -> Optional[FileMeta]:
         """Get file metadata for a specific user."""
-        metadata = self.metadata.get(file_id)
-        if metadata and metadata.get('user_id') == user_id:
-            return metadata
-        return None
+        return self._by_user.get(user_id, {}).get(file_id)
     
-    def _load_metadata(self) -> Dict:
-        """Load metadata from file."""
+    def _load_metadata(self) -> Dict[str, FileMeta]:
+        """Load metadata from the snapshot file, then replay the change log."""
+        metadata = {}
         try:
             if os.path.exists(self.metadata_file):
-                with open(self.metadata_file, 'r') as f:
-                    return json.load(f)
+                with open(self.metadata_file, 'rb') as f:
+                    data = f.read()
+                metadata = {file_id: FileMeta.from_dict(m) for file_id, m in _load_json(data).items()}
+                self._snapshot_size = len(data)
         except Exception as e:
             logger.error(f"Failed to load metadata: {e}")
         
-        return {}
+        try:
+            if os.path.exists(self.metadata_log):
+                with open(self.metadata_log, 'r+b') as f:
+                    good_size = 0
+                    for line in f:
+                        try:
+                            # Every record ends in a newline; one without it is cut short
+                            if not line.endswith(b'\n'):
+                                raise ValueError("incomplete record")
+                            change = _load_json(line)
+                        except ValueError:
+                            # Torn final write from a crash. Cut it off, or records
+                            # appended after it would be lost behind it on the next replay.
+                            logger.warning(f"Dropping torn metadata log record at offset {good_size}")
+                            f.truncate(good_size)
+                            break
+                        if change['op'] == 'put':
+                            metadata[change['id']] = FileMeta.from_dict(change['m'])
+                        else:
+                            metadata.pop(change['id'], None)
+                        good_size += len(line)
+                    self._log_size = good_size
+        except Exception as e:
+            logger.error(f"Failed to replay metadata log: {e}")
+        
+        return metadata
+    
+    async def _save_metadata(self, change: Dict):
+        """Queue a metadata change for the log and schedule a debounced write."""
+        self._pending_log.append(_dump_json(change) + b'\n')
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
     
-    async def _save_metadata(self):
-        """Save metadata to file."""
+    async def _flush_later(self):
+        """Write metadata after a short delay, repeating while changes keep arriving."""
+        while True:
+            await asyncio.sleep(METADATA_FLUSH_DELAY)
+            await self.flush_metadata()
+            if not self._pending_log:
+                break
+    
+    async def flush_metadata(self):
+        """
+        Write pending metadata changes now. Changes are appended to the log;
+        once the log outgrows the snapshot, a fresh snapshot replaces both.
+        """
+        async with self._metadata_lock:
+            await self._flush_pending()
+    
+    async def _flush_pending(self):
+        if not self._pending_log:
+            return
+        
+        lines = b''.join(self._pending_log)
+        self._pending_log = []
+        
+        # Serialize on the loop thread so the snapshot is consistent
+        snapshot = None
+        if self._log_size + len(lines) > self._snapshot_size:
+            snapshot = _dump_json(self.metadata)
+        
         try:
-            with open(self.metadata_file, 'w') as f:
-                json.dump(self.metadata, f, indent=2)
+            await asyncio.to_thread(self._write_metadata, lines, snapshot)
         except Exception as e:
+            self._pending_log.insert(0, lines)
             logger.error(f"Failed to save metadata: {e}")
-                
+            return
+        
+        if snapshot is not None:
+            self._snapshot_size = len(snapshot)
+            self._log_size = 0
+        else:
+            self._log_size += len(lines)
+    
+    def _write_metadata(self, lines: bytes, snapshot: Optional[bytes]):
+        """Append changes to the log, or compact everything into a new snapshot."""
+        if snapshot is None:
+            with open(self.metadata_log, 'ab') as f:
+                f.write(lines)
+            return
+        
+        # Write a uniquely named temp file and rename it over the snapshot, so
+        # readers only ever see a complete file
+        fd, temp_file = tempfile.mkstemp(prefix='meta_', dir=os.path.dirname(self.metadata_file))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.metadata_file)
+        except BaseException:
+            quiet_unlink(temp_file)
+            raise
+        # Replaying the old log over the new snapshot is harmless, so a crash here is safe
+        open(self.metadata_log, 'wb').close()
+    
+    async def close(self):
+        """Write any pending metadata changes and stop Mega work. Call on shutdown."""
+        if self._recount_task:
+            self._recount_task.cancel()
+        if self.mega_uploader:
+            self.mega_uploader.close()
+        if self._flush_task:
+            await self._flush_task
+        await self.flush_metadata()
@@ -3,13 +3,28 @@ Utility functions for the Telegram File Bot.
 Contains helper functions for file operations, formatting, and ID generation.
 """
 
+import asyncio
+import functools
 import hashlib
+import logging
+import mmap
 import os
-import random
-import string
+import secrets
+import shutil
+import threading
 import time
-from typing import Optional
+from typing import Iterator, Optional, Tuple
 
+try:
+    from blake3 import blake3
+except ImportError:  # blake3 is optional; fall back to hashlib
+    blake3 = None
+
+logger = logging.getLogger(__name__)
+
+_SIZE_NAMES = ("B", "KB", "MB", "GB", "TB")
+
+@functools.lru_cache(maxsize=1024)
 def format_file_size(size_bytes: int) -> str:
     """
     Format file size in human-readable format.
@@ -23,18 +38,13 @@ def format_file_size(size_bytes: int) -> str:
     if size_bytes == 0:
         return "0 B"
     
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    size = float(size_bytes)
-    
-    while size >= 1024.0 and i < len(size_names) - 1:
-        size /= 1024.0
-        i += 1
+    # Each unit is 2**10 of the previous one, so bit_length picks it directly
+    i = min((abs(size_bytes).bit_length() - 1) // 10, len(_SIZE_NAMES) - 1)
     
     if i == 0:
-        return f"{int(size)} {size_names[i]}"
+        return f"{size_bytes} {_SIZE_NAMES[i]}"
     else:
-        return f"{size:.1f} {size_names[i]}"
+        return f"{size_bytes / (1 << (10 * i)):.1f} {_SIZE_NAMES[i]}"
 
 def calculate_compression_ratio(original_size: int, compressed_size: int) -> float:
     """
@@ -60,30 +70,189 @@ def generate_file_id() -> str:
     Returns:
         Unique file identifier string
     """
-    timestamp = str(int(time.time()))
-    random_chars = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
-    return f"{timestamp}_{random_chars}"
+    return f"{int(time.time())}_{secrets.token_hex(3)}"
+
+# Window hashed per update() in generate_file_hash, bounding resident pages
+_HASH_WINDOW_SIZE = 64 * 1024 * 1024
 
 def generate_file_hash(file_path: str) -> str:
     """
-    Generate MD5 hash of a file.
+    Generate a 128-bit hash of a file.
+    
+    Uses BLAKE3 (SIMD, multithreaded, mmap-backed) when the blake3 package is
+    installed, otherwise BLAKE2b over memory-mapped 64 MiB windows. The two
+    produce different digests, so compare hashes made by the same install.
     
     Args:
         file_path: Path to file
         
     Returns:
-        MD5 hash string
+        Hex digest string (32 characters)
     """
-    hash_md5 = hashlib.md5()
-    
     try:
+        if blake3 is not None:
+            return blake3(max_threads=blake3.AUTO).update_mmap(file_path).hexdigest(length=16)
+        
+        file_hash = hashlib.blake2b(digest_size=16)
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return file_hash.hexdigest()
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # The view must be released before the mapping can close
+                with memoryview(mm) as view:
+                    for offset in range(0, size, _HASH_WINDOW_SIZE):
+                        file_hash.update(view[offset:offset + _HASH_WINDOW_SIZE])
+        return file_hash.hexdigest()
     except Exception:
         return ""
 
+# Buffer size for the userspace leg of fast_copy, reused per worker thread
+_COPY_BUFFER_SIZE = 1024 * 1024
+_copy_buffers = threading.local()
+
+def fast_copy(src: str, dst: str) -> None:
+    """
+    Copy a file like shutil.copy2, preferring in-kernel copies.
+    
+    Tries copy_file_range (reflink/server-side copy where supported), then
+    sendfile, then a 1 MiB readinto loop, continuing from wherever the
+    previous method stopped.
+    
+    Args:
+        src: Source file path
+        dst: Destination file path
+    """
+    # O_CLOEXEC keeps the descriptors out of subprocesses (pigz/xz) spawned meanwhile
+    src_fd = os.open(src, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            remaining = os.fstat(src_fd).st_size
+            offset = 0
+            
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while remaining > 0:
+                        copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                        if copied == 0:
+                            break
+                        offset += copied
+                        remaining -= copied
+                except OSError:
+                    pass
+            
+            if remaining > 0 and hasattr(os, 'sendfile'):
+                try:
+                    while remaining > 0:
+                        sent = os.sendfile(dst_fd, src_fd, offset, remaining)
+                        if sent == 0:
+                            break
+                        offset += sent
+                        remaining -= sent
+                except OSError:
+                    pass
+            
+            if remaining > 0:
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                buffer = getattr(_copy_buffers, 'buffer', None)
+                if buffer is None:
+                    buffer = _copy_buffers.buffer = bytearray(_COPY_BUFFER_SIZE)
+                view = memoryview(buffer)
+                with open(src_fd, 'rb', buffering=0, closefd=False) as f_in:
+                    while True:
+                        n = f_in.readinto(buffer)
+                        if not n:
+                            break
+                        os.write(dst_fd, view[:n])
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    
+    shutil.copystat(src, dst)
+
+def iter_files(root: str) -> Iterator[Tuple[str, int, float]]:
+    """
+    Walk a directory tree without an extra stat per file.
+    
+    Uses os.scandir, whose entries carry the file type from the directory
+    listing; symlinks are not followed and unreadable entries are skipped.
+    
+    Args:
+        root: Directory to walk
+        
+    Yields:
+        (path, size, mtime) for every regular file under root
+    """
+    pending = [root]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            yield entry.path, stat.st_size, stat.st_mtime
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Async context manager capping how many operations run at once. The cap
+    adapts AIMD-style: each success raises it slightly, each failure halves
+    it, so callers back off when a remote service starts failing.
+    """
+    
+    def __init__(self, max_concurrency: int = 16, min_concurrency: int = 1, initial_concurrency: int = 2):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency)
+        self._in_flight = 0
+        self._changed = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._changed:
+            self._in_flight -= 1
+            if exc_type is None:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif not issubclass(exc_type, asyncio.CancelledError):
+                self.limit = max(self.min_concurrency, self.limit / 2)
+            self._changed.notify_all()
+        return False
+
+def quiet_unlink(file_path: Optional[str]) -> None:
+    """
+    Remove a file if it exists, ignoring errors.
+    
+    Args:
+        file_path: Path to file (None is ignored)
+    """
+    if not file_path:
+        return
+    
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.debug(f"Failed to remove {file_path}: {e}")
+
+# Characters invalid in filenames on common file systems, mapped to '_'
+_SANITIZE_TABLE = str.maketrans({char: '_' for char in '<>:"/\\|?*'})
+
 def sanitize_filename(filename: str) -> str:
     """
     Sanitize filename by removing invalid characters.
@@ -94,19 +263,9 @@ def sanitize_filename(filename: str) -> str:
     Returns:
         Sanitized filename safe for file system
     """
-    # Remove invalid characters for most file systems
-    invalid_chars = '<>:"/\\|?*'
-    for char in invalid_chars:
-        filename = filename.replace(char, '_')
-    
-    # Remove leading/trailing spaces and dots
-    filename = filename.strip('. ')
-    
-    # Ensure filename is not empty
-    if not filename:
-        filename = f"file_{int(time.time())}"
-    
-    return filename
+    # Replace invalid characters for most file systems, then remove
+    # leading/trailing spaces and dots; never return an empty name
+    return filename.translate(_SANITIZE_TABLE).strip('. ') or f"file_{int(time.time())}"
 
 def get_file_extension(filename: str) -> str:
     """
@@ -123,6 +282,15 @@ def get_file_extension(filename: str) -> str:
     except:
         return ""
 
+_MEDIA_EXTENSIONS = frozenset({
+    # Images
+    'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg',
+    # Video
+    'mp4', 'avi', 'mkv', 'mov', 'wmv', 'flv', 'webm',
+    # Audio
+    'mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a',
+})
+
 def is_media_file(filename: str) -> bool:
     """
     Check if file is a media file based on extension.
@@ -133,19 +301,18 @@ def is_media_file(filename: str) -> bool:
     Returns:
         True if media file, False otherwise
     """
-    media_extensions = {
-        'image': ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg'],
-        'video': ['mp4', 'avi', 'mkv', 'mov', 'wmv', 'flv', 'webm'],
-        'audio': ['mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a']
-    }
-    
-    extension = get_file_extension(filename)
-    
-    for media_type, extensions in media_extensions.items():
-        if extension in extensions:
-            return True
-    
-    return False
+    return get_file_extension(filename) in _MEDIA_EXTENSIONS
+
+# Rough compression ratios per algorithm, by file type
+_TEXT_RATIOS = {'lzma': 0.2, 'gzip': 0.3, 'zip': 0.4}
+_COMPRESSED_RATIOS = {'lzma': 0.95, 'gzip': 0.95, 'zip': 0.95}
+_DOCUMENT_RATIOS = {'lzma': 0.6, 'gzip': 0.7, 'zip': 0.8}
+_GENERAL_RATIOS = {'lzma': 0.5, 'gzip': 0.6, 'zip': 0.7}
+_ESTIMATED_RATIOS = {
+    **dict.fromkeys(('txt', 'log', 'csv', 'json', 'xml', 'html'), _TEXT_RATIOS),
+    **dict.fromkeys(('jpg', 'png', 'mp3', 'mp4', 'zip', 'rar'), _COMPRESSED_RATIOS),
+    **dict.fromkeys(('pdf', 'doc', 'docx'), _DOCUMENT_RATIOS),
+}
 
 def estimate_compression_size(file_path: str, algorithm: str = 'zip') -> Optional[int]:
     """
@@ -163,21 +330,8 @@ def estimate_compression_size(file_path: str, algorithm: str = 'zip') -> Optiona
         original_size = os.path.getsize(file_path)
         extension = get_file_extension(file_path)
         
-        # Compression ratios based on file type (rough estimates)
-        if extension in ['txt', 'log', 'csv', 'json', 'xml', 'html']:
-            # Text files compress very well
-            ratio = 0.2 if algorithm == 'lzma' else 0.3 if algorithm == 'gzip' else 0.4
-        elif extension in ['jpg', 'png', 'mp3', 'mp4', 'zip', 'rar']:
-            # Already compressed files
-            ratio = 0.95
-        elif extension in ['pdf', 'doc', 'docx']:
-            # Document files
-            ratio = 0.6 if algorithm == 'lzma' else 0.7 if algorithm == 'gzip' else 0.8
-        else:
-            # General files
-            ratio = 0.5 if algorithm == 'lzma' else 0.6 if algorithm == 'gzip' else 0.7
-        
-        return int(original_size * ratio)
+        ratios = _ESTIMATED_RATIOS.get(extension, _GENERAL_RATIOS)
+        return int(original_size * ratios.get(algorithm, ratios['zip']))
         
     except:
         return None
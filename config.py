@@ -7,15 +7,22 @@ import os
 from dataclasses import dataclass
 from typing import Optional
 
-@dataclass
+def _env_int(name: str, default: int) -> int:
+    """Read an integer environment variable, falling back to default if unset or invalid."""
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+@dataclass(frozen=True, slots=True)
 class Config:
-    """Configuration class for bot settings."""
+    """Configuration class for bot settings. Build it with Config.from_env()."""
     
     # Telegram Bot API
     BOT_TOKEN: str
     
     # Telegram MTProto API
-    API_ID: str
+    API_ID: int
     API_HASH: str
     
     # Mega.nz credentials
@@ -28,60 +35,95 @@ class Config:
     MAX_FILE_SIZE: int
     
     # Compression settings
-    DEFAULT_COMPRESSION: int
-    COMPRESSION_LEVEL: str
+    DEFAULT_COMPRESSION: str
+    COMPRESSION_LEVEL: int
+    PARALLEL_THRESHOLD: int
+    KEEP_LOCAL_BACKUP: bool
+    
+    # Uploads processed at once (bounds memory and temp disk use)
+    MAX_CONCURRENT_UPLOADS: int
+    
+    # Bot API connections for outgoing calls (polling has its own connection)
+    BOT_API_POOL_SIZE: int
+    
+    # Webhook settings (polling is used when WEBHOOK_URL is unset)
+    WEBHOOK_URL: Optional[str]
+    WEBHOOK_QUEUE_SIZE: int
+    WEBHOOK_WORKERS: int
     
-    def __init__(self):
+    # Polled updates handled at once (the polling counterpart of WEBHOOK_WORKERS)
+    POLLING_CONCURRENCY: int
+    
+    # Parallel part requests per large Telegram download
+    DOWNLOAD_WORKERS: int
+    
+    @classmethod
+    def from_env(cls) -> "Config":
+        """Load settings from environment variables, applying defaults."""
         # Required Telegram settings
-        self.BOT_TOKEN = os.getenv("BOT_TOKEN")
-        if not self.BOT_TOKEN:
+        bot_token = os.getenv("BOT_TOKEN")
+        if not bot_token:
             raise ValueError("BOT_TOKEN environment variable is required")
         
         try:
-            self.API_ID = int(os.getenv("API_ID"))
+            api_id = int(os.getenv("API_ID"))
         except (TypeError, ValueError):
             raise ValueError("API_ID environment variable is required and must be an integer")
         
-        self.API_HASH = os.getenv("API_HASH")
-        if not self.API_HASH:
+        api_hash = os.getenv("API_HASH")
+        if not api_hash:
             raise ValueError("API_HASH environment variable is required")
         
         # Mega.nz credentials
-        self.MEGA_EMAIL = os.getenv("MEGA_EMAIL")
-        self.MEGA_PASSWORD = os.getenv("MEGA_PASSWORD")
+        mega_email = os.getenv("MEGA_EMAIL")
+        mega_password = os.getenv("MEGA_PASSWORD")
         
-        if not self.MEGA_EMAIL or not self.MEGA_PASSWORD:
+        if not mega_email or not mega_password:
             raise ValueError("MEGA_EMAIL and MEGA_PASSWORD environment variables are required")
         
         # Optional settings with defaults
         try:
-            self.STORAGE_CHANNEL_ID = int(os.getenv("STORAGE_CHANNEL_ID")) if os.getenv("STORAGE_CHANNEL_ID") else None
-        except ValueError:
-            self.STORAGE_CHANNEL_ID = None
-        
-        self.TEMP_DIR = os.getenv("TEMP_DIR", "./temp")
-        
-        try:
-            self.MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "4294967296"))  # 4GB default
+            storage_channel_id = int(os.getenv("STORAGE_CHANNEL_ID")) if os.getenv("STORAGE_CHANNEL_ID") else None
         except ValueError:
-            self.MAX_FILE_SIZE = 4294967296
+            storage_channel_id = None
         
-        self.DEFAULT_COMPRESSION = os.getenv("DEFAULT_COMPRESSION", "zip")
-        
-        try:
-            self.COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
-        except ValueError:
-            self.COMPRESSION_LEVEL = 6
+        temp_dir = os.getenv("TEMP_DIR", "./temp")
         
         # Ensure temp directory exists
-        os.makedirs(self.TEMP_DIR, exist_ok=True)
+        os.makedirs(temp_dir, exist_ok=True)
+        
+        return cls(
+            BOT_TOKEN=bot_token,
+            API_ID=api_id,
+            API_HASH=api_hash,
+            MEGA_EMAIL=mega_email,
+            MEGA_PASSWORD=mega_password,
+            STORAGE_CHANNEL_ID=storage_channel_id,
+            TEMP_DIR=temp_dir,
+            MAX_FILE_SIZE=_env_int("MAX_FILE_SIZE", 4294967296),  # 4GB default
+            DEFAULT_COMPRESSION=os.getenv("DEFAULT_COMPRESSION", "zip"),
+            COMPRESSION_LEVEL=_env_int("COMPRESSION_LEVEL", 6),
+            PARALLEL_THRESHOLD=_env_int("PARALLEL_THRESHOLD", 33554432),  # 32MB default
+            # When false, files safely stored in the channel get no local copy
+            KEEP_LOCAL_BACKUP=os.getenv("KEEP_LOCAL_BACKUP", "true").lower() not in ("0", "false", "no"),
+            MAX_CONCURRENT_UPLOADS=max(1, _env_int("MAX_CONCURRENT_UPLOADS", 4)),
+            BOT_API_POOL_SIZE=max(1, _env_int("BOT_API_POOL_SIZE", 32)),
+            WEBHOOK_URL=os.getenv("WEBHOOK_URL") or None,
+            WEBHOOK_QUEUE_SIZE=_env_int("WEBHOOK_QUEUE_SIZE", 100),
+            # At least one worker, or nothing drains the queue and every webhook gets a 503
+            WEBHOOK_WORKERS=max(1, _env_int("WEBHOOK_WORKERS", 8)),
+            POLLING_CONCURRENCY=max(1, _env_int("POLLING_CONCURRENCY", 8)),
+            DOWNLOAD_WORKERS=max(1, _env_int("DOWNLOAD_WORKERS", 8)),
+        )
     
     def validate(self) -> bool:
         """Validate configuration settings."""
         if not all([self.BOT_TOKEN, self.API_ID, self.API_HASH, self.MEGA_EMAIL, self.MEGA_PASSWORD]):
             return False
         
-        if self.DEFAULT_COMPRESSION not in ["zip", "gzip", "lzma"]:
+        # Imported here so loading the config doesn't pull in the codecs
+        from bot.compression import supported_algorithms
+        if self.DEFAULT_COMPRESSION not in supported_algorithms():
             return False
         
         if not 1 <= self.COMPRESSION_LEVEL <= 9:
@@ -100,5 +142,14 @@ class Config:
     TEMP_DIR={self.TEMP_DIR},
     MAX_FILE_SIZE={self.MAX_FILE_SIZE // (1024**3)}GB,
     DEFAULT_COMPRESSION={self.DEFAULT_COMPRESSION},
-    COMPRESSION_LEVEL={self.COMPRESSION_LEVEL}
+    COMPRESSION_LEVEL={self.COMPRESSION_LEVEL},
+    PARALLEL_THRESHOLD={self.PARALLEL_THRESHOLD // (1024**2)}MB,
+    KEEP_LOCAL_BACKUP={self.KEEP_LOCAL_BACKUP},
+    MAX_CONCURRENT_UPLOADS={self.MAX_CONCURRENT_UPLOADS},
+    BOT_API_POOL_SIZE={self.BOT_API_POOL_SIZE},
+    WEBHOOK_URL={self.WEBHOOK_URL or 'Not set'},
+    WEBHOOK_QUEUE_SIZE={self.WEBHOOK_QUEUE_SIZE},
+    WEBHOOK_WORKERS={self.WEBHOOK_WORKERS},
+    POLLING_CONCURRENCY={self.POLLING_CONCURRENCY},
+    DOWNLOAD_WORKERS={self.DOWNLOAD_WORKERS}
 )"""
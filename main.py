@@ -8,28 +8,132 @@ Includes web server for port 5000 support on hosting platforms.
 import asyncio
 import logging
 import os
-import aiohttp
+import random
 import time
 import json
 import signal
+import socket
+import sys
+import httpx
 from aiohttp import web
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from telegram.ext import ContextTypes
 from telegram import Update
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 from telethon import TelegramClient, errors
 from config import Config
 from bot.handlers import BotHandlers
+from bot.utils import quiet_unlink
+
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:  # orjson is optional; fall back to the stdlib
+    from json import loads as _json_loads
+    
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+try:
+    # httpx only speaks HTTP/2 when h2 is installed
+    import h2
+    BOT_API_HTTP_VERSION = "2"
+except ImportError:
+    BOT_API_HTTP_VERSION = "1.1"
+
+# Bot API sockets: no Nagle delay on small calls like progress edits, and TCP
+# keepalive probes so a silently dropped pooled connection is noticed
+BOT_API_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    BOT_API_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 15))
+
+# Seconds an idle pooled connection is kept (httpx closes them after 5 s), so
+# sporadic commands reuse it instead of paying a new TLS handshake
+BOT_API_KEEPALIVE_EXPIRY = 60.0
+
+def _bot_api_transport(pool_size: int, http2: bool = False) -> httpx.AsyncHTTPTransport:
+    """
+    Build a Bot API transport with the socket options, pool limits and HTTP
+    version set on it directly. httpx ignores the client's limits and http2
+    settings once a transport is given, so they can't be left to PTB.
+    """
+    return httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY
+        ),
+        socket_options=BOT_API_SOCKET_OPTIONS
+    )
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# The format uses none of these, so skip collecting them for every record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+# httpx logs every Bot API request at INFO, including each long poll
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# Bot command -> BotHandlers method
+COMMAND_HANDLERS = (
+    ("start", "start_command"),
+    ("help", "help_command"),
+    ("upload", "upload_command"),
+    ("download", "download_command"),
+    ("list", "list_files_command"),
+    ("delete", "delete_file_command"),
+    ("compress", "compress_command"),
+    ("settings", "settings_command"),
+)
+
+class BotAPIRequest(HTTPXRequest):
+    """PTB's HTTPX transport, decoding Bot API responses with orjson when available."""
+    __slots__ = ()
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return _json_loads(payload)
+        except ValueError as exc:
+            raise TelegramError("Invalid server response") from exc
+
+class _UploadFilter(filters.MessageFilter):
+    """
+    Messages handled as file uploads: the same test as
+    Document.ALL | PHOTO | VIDEO | AUDIO, in one call instead of an OR tree
+    of four filters evaluated for every update.
+    """
+    __slots__ = ()
+    
+    def filter(self, message) -> bool:
+        return bool(message.document or message.photo or message.video or message.audio)
+
+UPLOAD_FILTER = _UploadFilter(name='UploadFilter')
+
+# Constant body of the root endpoint, encoded once
+ROOT_RESPONSE_BODY = b"Bot is running!"
+
+# Largest webhook request body accepted (aiohttp's default is 1 MiB)
+WEBHOOK_MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# Seconds in-flight uploads get to finish at shutdown before they are cancelled
+UPLOAD_SHUTDOWN_GRACE = 20
+
+# Seconds a /health response is reused, so frequent keepalive pings don't
+# each probe the clients
+HEALTH_CACHE_TTL = 5.0
+
 class TelegramFileBot:
     def __init__(self):
-        self.config = Config()
+        self.config = Config.from_env()
         self.bot_handlers = None
         self.telethon_client = None
         self.application = None
@@ -37,10 +141,21 @@ class TelegramFileBot:
         self.runner = None
         self.site = None
         self.max_retries = 5
-        self.retry_delay = 10  # seconds
+        self.retry_delay = 10  # seconds; cap for the exponential backoff between attempts
         self.is_running = False
+        self._stop_event = asyncio.Event()  # Set by signal handlers to end run()
+        self.exit_code = 0  # Non-zero when run() ends abnormally, so the platform restarts us
         self.lock_file = "bot.lock"
+        # Webhook updates wait here for a fixed pool of workers (bounded backlog)
+        self._update_queue = None
+        self._update_workers = []
+        self._health_body = None
+        self._health_expires = 0.0
         
+    def _backoff(self, attempt: int) -> float:
+        """Delay before retry number attempt + 1: exponential from 0.5 s, capped, with jitter."""
+        return min(self.retry_delay, 0.5 * 2 ** attempt) + random.uniform(0, 0.25)
+    
     def check_existing_instance(self):
         """Check if another bot instance is already running."""
         if os.path.exists(self.lock_file):
@@ -76,11 +191,7 @@ class TelegramFileBot:
     
     def remove_lock_file(self):
         """Remove the lock file."""
-        try:
-            if os.path.exists(self.lock_file):
-                os.remove(self.lock_file)
-        except IOError:
-            logger.warning("Failed to remove lock file")
+        quiet_unlink(self.lock_file)
     
     async def initialize_telethon(self):
         """Initialize Telethon client with retry logic."""
@@ -88,6 +199,8 @@ class TelegramFileBot:
             try:
                 logger.info(f"Attempting to initialize Telethon client (attempt {attempt + 1}/{self.max_retries})")
                 
+                # The SQLite session keeps the DC and auth key between runs, so an
+                # authorized session starts with one get_me() instead of a sign-in
                 self.telethon_client = TelegramClient(
                     'bot_session',
                     self.config.API_ID,
@@ -96,28 +209,50 @@ class TelegramFileBot:
                     connection_retries=3
                 )
                 
-                # Start Telethon client with timeout
+                # Start Telethon client with timeout; a stuck handshake fails fast into a retry
                 await asyncio.wait_for(
                     self.telethon_client.start(bot_token=self.config.BOT_TOKEN),
-                    timeout=30
+                    timeout=15
                 )
                 
                 logger.info("Telethon client initialized successfully")
                 return True
                 
-            except (errors.ConnectionError, asyncio.TimeoutError, errors.RPCError) as e:
+            # Network failures surface as OSError (ConnectionError included);
+            # telethon.errors has no ConnectionError of its own
+            except (OSError, asyncio.TimeoutError, errors.RPCError) as e:
                 logger.error(f"Telethon initialization failed (attempt {attempt + 1}): {e}")
+                await self._close_failed_telethon()
                 if attempt < self.max_retries - 1:
-                    logger.info(f"Retrying in {self.retry_delay} seconds...")
-                    await asyncio.sleep(self.retry_delay)
+                    delay = self._backoff(attempt)
+                    logger.info(f"Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
                 else:
                     logger.error("Max retries exceeded for Telethon initialization")
                     return False
             except Exception as e:
                 logger.error(f"Unexpected error during Telethon initialization: {e}")
+                await self._close_failed_telethon()
                 return False
+            except BaseException:
+                # Cancelled (e.g. shutdown during startup)
+                await self._close_failed_telethon()
+                raise
                 
         return False
+    
+    async def _close_failed_telethon(self):
+        """
+        Disconnect a client whose start failed, so it releases the session file;
+        a retry then resumes with the saved auth key instead of signing in.
+        """
+        client, self.telethon_client = self.telethon_client, None
+        if client is None:
+            return
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.warning(f"Could not disconnect failed Telethon client: {e}")
         
     async def initialize_bot_api(self):
         """Initialize Bot API application with retry logic."""
@@ -129,9 +264,35 @@ class TelegramFileBot:
                 self.application = (
                     Application.builder()
                     .token(self.config.BOT_TOKEN)
-                    .pool_timeout(30)
-                    .read_timeout(30)
-                    .write_timeout(30)
+                    .request(BotAPIRequest(
+                        # PTB's builder default (256) is far more than this bot uses and
+                        # a risk to the file descriptor limit on small hosts
+                        connection_pool_size=self.config.BOT_API_POOL_SIZE,
+                        # Fail fast on a busy pool or unreachable host; final replies are
+                        # retried on timeout (see bot.handlers). Reads stay generous, since
+                        # Telegram answers a large sendDocument only after processing it.
+                        pool_timeout=3,
+                        connect_timeout=5,
+                        read_timeout=30,
+                        write_timeout=30,
+                        # Sending a file back (up to 50 MB) can take far longer than a plain call
+                        media_write_timeout=600,
+                        # With HTTP/2, concurrent calls share a few multiplexed connections
+                        http_version=BOT_API_HTTP_VERSION,
+                        httpx_kwargs={"transport": _bot_api_transport(
+                            self.config.BOT_API_POOL_SIZE, http2=BOT_API_HTTP_VERSION == "2"
+                        )}
+                    ))
+                    # Long polling gets its own connection, so it never holds one
+                    # that replies and progress edits are waiting for. PTB adds the
+                    # long-poll timeout to read_timeout on every getUpdates call.
+                    .get_updates_request(BotAPIRequest(
+                        connect_timeout=10,
+                        pool_timeout=10,
+                        httpx_kwargs={"transport": _bot_api_transport(1)}
+                    ))
+                    # Polled updates are handled in parallel, like the webhook worker pool
+                    .concurrent_updates(self.config.POLLING_CONCURRENCY)
                     .build()
                 )
                 
@@ -143,8 +304,9 @@ class TelegramFileBot:
             except Exception as e:
                 logger.error(f"Bot API initialization failed (attempt {attempt + 1}): {e}")
                 if attempt < self.max_retries - 1:
-                    logger.info(f"Retrying in {self.retry_delay} seconds...")
-                    await asyncio.sleep(self.retry_delay)
+                    delay = self._backoff(attempt)
+                    logger.info(f"Retrying in {delay:.1f} seconds...")
+                    await asyncio.sleep(delay)
                 else:
                     logger.error("Max retries exceeded for Bot API initialization")
                     return False
@@ -154,9 +316,11 @@ class TelegramFileBot:
     async def initialize_web_server(self):
         """Initialize web server for port 5000."""
         try:
-            self.web_app = web.Application()
+            self.web_app = web.Application(client_max_size=WEBHOOK_MAX_BODY_SIZE)
             self.web_app.router.add_get('/', self.handle_web_request)
             self.web_app.router.add_get('/health', self.handle_health_check)
+            if self.config.WEBHOOK_URL:
+                self.web_app.router.add_post(f'/{self.config.BOT_TOKEN}', self.handle_webhook)
             logger.info("Web server initialized successfully")
             return True
         except Exception as e:
@@ -165,17 +329,60 @@ class TelegramFileBot:
     
     async def handle_web_request(self, request):
         """Handle web requests to keep the bot alive on hosting platforms."""
-        return web.Response(text="Bot is running!")
+        return web.Response(body=ROOT_RESPONSE_BODY, content_type='text/plain')
+    
+    async def handle_webhook(self, request):
+        """
+        Receive an update from Telegram. The update is queued and acknowledged
+        at once, so slow handlers (uploads) neither delay the response nor
+        trigger Telegram's redelivery. A full queue answers 503 and Telegram
+        retries later.
+        """
+        try:
+            # Drain the body in one read rather than through request.json()
+            update = Update.de_json(_json_loads(await request.read()), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Ignoring malformed webhook update: {e}")
+            return web.Response(status=400)
+        
+        try:
+            self._update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning("Webhook update queue is full; asking Telegram to retry")
+            return web.Response(status=503)
+        return web.Response()
+    
+    def start_update_workers(self):
+        """Create the webhook update queue and the workers draining it."""
+        self._update_queue = asyncio.Queue(maxsize=self.config.WEBHOOK_QUEUE_SIZE)
+        self._update_workers = [
+            asyncio.create_task(self._update_worker()) for _ in range(self.config.WEBHOOK_WORKERS)
+        ]
+    
+    async def _update_worker(self):
+        """Process queued webhook updates one at a time."""
+        while True:
+            update = await self._update_queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Webhook update processing failed: {e}")
+            finally:
+                self._update_queue.task_done()
     
     async def handle_health_check(self, request):
         """Health check endpoint for monitoring."""
-        status = {
-            "status": "healthy",
-            "timestamp": time.time(),
-            "telethon_connected": self.telethon_client is not None and self.telethon_client.is_connected(),
-            "bot_api_connected": self.application is not None and self.application.running
-        }
-        return web.json_response(status)
+        now = time.monotonic()
+        if now >= self._health_expires:
+            status = {
+                "status": "healthy",
+                "timestamp": time.time(),
+                "telethon_connected": self.telethon_client is not None and self.telethon_client.is_connected(),
+                "bot_api_connected": self.application is not None and self.application.running
+            }
+            self._health_body = _json_dumps(status)
+            self._health_expires = now + HEALTH_CACHE_TTL
+        return web.Response(body=self._health_body, content_type='application/json')
         
     async def initialize_handlers(self):
         """Initialize bot handlers."""
@@ -186,21 +393,12 @@ class TelegramFileBot:
                 config=self.config
             )
             
-            # Register command handlers
-            self.application.add_handler(CommandHandler("start", self.bot_handlers.start_command))
-            self.application.add_handler(CommandHandler("help", self.bot_handlers.help_command))
-            self.application.add_handler(CommandHandler("upload", self.bot_handlers.upload_command))
-            self.application.add_handler(CommandHandler("download", self.bot_handlers.download_command))
-            self.application.add_handler(CommandHandler("list", self.bot_handlers.list_files_command))
-            self.application.add_handler(CommandHandler("delete", self.bot_handlers.delete_file_command))
-            self.application.add_handler(CommandHandler("compress", self.bot_handlers.compress_command))
-            self.application.add_handler(CommandHandler("settings", self.bot_handlers.settings_command))
-            
-            # Handle file uploads
-            self.application.add_handler(MessageHandler(
-                filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO,
-                self.bot_handlers.handle_file_upload
-            ))
+            # Register command handlers and file uploads in one batch
+            self.application.add_handlers([
+                *(CommandHandler(command, getattr(self.bot_handlers, attr)) for command, attr in COMMAND_HANDLERS),
+                # Non-blocking, so a long upload doesn't hold up other updates
+                MessageHandler(UPLOAD_FILTER, self.bot_handlers.handle_file_upload, block=False),
+            ])
             
             logger.info("Bot handlers registered successfully")
             return True
@@ -214,18 +412,20 @@ class TelegramFileBot:
         # Check if another instance is already running
         if self.check_existing_instance():
             logger.error("Another bot instance is already running. Exiting.")
+            self.exit_code = 1
             return
             
         # Create lock file to prevent multiple instances
         if not self.create_lock_file():
             logger.error("Failed to create lock file. Exiting.")
+            self.exit_code = 1
             return
             
         # Set up signal handlers for graceful shutdown
         try:
             loop = asyncio.get_running_loop()
             for sig in (signal.SIGTERM, signal.SIGINT):
-                loop.add_signal_handler(sig, lambda: asyncio.create_task(self.shutdown()))
+                loop.add_signal_handler(sig, self._stop_event.set)
         except (NotImplementedError, RuntimeError):
             # Signal handlers not supported on this platform
             pass
@@ -234,31 +434,43 @@ class TelegramFileBot:
             logger.info("Starting Telegram File Bot...")
             self.is_running = True
             
-            # Initialize components with retry logic
-            telethon_success = await self.initialize_telethon()
-            bot_api_success = await self.initialize_bot_api()
-            web_server_success = await self.initialize_web_server()
+            # Initialize components with retry logic; they are independent, so connect concurrently
+            telethon_success, bot_api_success, web_server_success = await asyncio.gather(
+                self.initialize_telethon(),
+                self.initialize_bot_api(),
+                self.initialize_web_server()
+            )
             
             if not (telethon_success and bot_api_success):
                 logger.error("Failed to initialize Telegram clients. Exiting.")
+                self.exit_code = 1
                 return
                 
             # Initialize handlers
             if not await self.initialize_handlers():
                 logger.error("Failed to initialize handlers. Exiting.")
+                self.exit_code = 1
                 return
             
+            # Log in to Mega now so the first upload doesn't pay for it
+            await self.bot_handlers.storage_manager.initialize()
+            
             # Start the bot
             await self.application.initialize()
             await self.application.start()
             
             # Use webhook instead of polling if WEBHOOK_URL is set
-            if hasattr(self.config, 'WEBHOOK_URL') and self.config.WEBHOOK_URL:
+            if self.config.WEBHOOK_URL:
+                self.start_update_workers()
                 webhook_url = f"{self.config.WEBHOOK_URL}/{self.config.BOT_TOKEN}"
-                await self.application.bot.set_webhook(webhook_url)
+                await self.application.bot.set_webhook(
+                    webhook_url,
+                    drop_pending_updates=True  # Avoid processing old updates
+                )
                 logger.info(f"Webhook set to: {webhook_url}")
             else:
                 await self.application.updater.start_polling(
+                    timeout=30,  # Long-poll, so idle periods cost one request per 30 s
                     drop_pending_updates=True,  # Avoid processing old updates
                     allowed_updates=['message', 'callback_query']  # Only listen to specific updates
                 )
@@ -266,7 +478,8 @@ class TelegramFileBot:
             
             # Start web server on port 5000
             port = int(os.environ.get('PORT', 5000))
-            self.runner = web.AppRunner(self.web_app)
+            # No per-request access log line; webhook and health hits are frequent
+            self.runner = web.AppRunner(self.web_app, access_log=None)
             await self.runner.setup()
             self.site = web.TCPSite(self.runner, '0.0.0.0', port)
             await self.site.start()
@@ -274,14 +487,23 @@ class TelegramFileBot:
             logger.info(f"Bot is running! Web server started on port {port}")
             logger.info("Press Ctrl+C to stop.")
             
-            # Keep the bot running
-            while self.is_running:
-                await asyncio.sleep(1)
+            # Keep the bot running until a shutdown signal arrives, or until Telethon
+            # gives up reconnecting (large files can't be served; exit so we get restarted)
+            stop_wait = asyncio.create_task(self._stop_event.wait())
+            await asyncio.wait(
+                {stop_wait, self.telethon_client.disconnected},
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not stop_wait.done():
+                stop_wait.cancel()
+                logger.error("Telethon client disconnected permanently; shutting down")
+                self.exit_code = 1
                 
         except KeyboardInterrupt:
             logger.info("Bot stopped by user")
         except Exception as e:
             logger.error(f"Bot error: {e}")
+            self.exit_code = 1
         finally:
             await self.shutdown()
     
@@ -293,31 +515,67 @@ class TelegramFileBot:
         self.is_running = False
         logger.info("Shutting down bot...")
         
+        try:
+            # Stop taking updates first; in-flight uploads still need Telethon and storage
+            steps = [self._stop_application()]
+            if self.runner:
+                steps.append(self.runner.cleanup())
+            await self._run_shutdown_steps(steps)
+            
+            steps = []
+            if self.telethon_client and self.telethon_client.is_connected():
+                steps.append(self.telethon_client.disconnect())
+            if self.bot_handlers:
+                steps.append(self.bot_handlers.storage_manager.close())
+            await self._run_shutdown_steps(steps)
+        finally:
+            self.remove_lock_file()
+        logger.info("Bot shutdown complete")
+    
+    @staticmethod
+    async def _run_shutdown_steps(steps):
+        """Run shutdown steps concurrently; a failing step is logged and doesn't cancel the others."""
+        for result in await asyncio.gather(*steps, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Shutdown step failed: {result}")
+    
+    async def _stop_application(self):
+        """Stop update delivery and the PTB application, letting short-running handlers finish."""
         if self.application and hasattr(self.application, 'updater') and self.application.updater.running:
             await self.application.updater.stop()
         
+        for worker in self._update_workers:
+            worker.cancel()
+        
+        # application.stop() waits for running handlers; don't let a multi-GB
+        # upload hold shutdown past the platform's kill deadline
+        if self.bot_handlers:
+            await self.bot_handlers.cancel_uploads(UPLOAD_SHUTDOWN_GRACE)
+        
         if self.application and self.application.running:
             await self.application.stop()
             await self.application.shutdown()
-        
-        if self.telethon_client and self.telethon_client.is_connected():
-            await self.telethon_client.disconnect()
-            
-        if self.runner:
-            await self.runner.cleanup()
-        
-        self.remove_lock_file()
-        logger.info("Bot shutdown complete")
 
-async def main():
-    """Main entry point."""
+async def main() -> int:
+    """Main entry point. Returns the process exit status."""
     bot = TelegramFileBot()
     await bot.run()
+    return bot.exit_code
 
 if __name__ == "__main__":
     # Set event loop policy for Windows compatibility
     if os.name == 'nt':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        uvloop = None
+    else:
+        try:
+            # uvloop is optional; it speeds up the aiohttp server and socket I/O
+            import uvloop
+        except ImportError:
+            uvloop = None
     
-    # Run the bot
-    asyncio.run(main())
+    # Run the bot; a non-zero status lets on-failure restart policies kick in
+    if uvloop is not None:
+        sys.exit(uvloop.run(main()))
+    else:
+        sys.exit(asyncio.run(main()))